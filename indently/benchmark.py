@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import imp
+import math
+import os
+import random
+import re
+import sys
+import timeit
+
+import indently.executor
+import indently.lib
+
+
+def parse_args(args=None):
+    args = args or sys.argv[1:]
+
+    parser = argparse.ArgumentParser(
+        description="Time indently's tokenizer backends against each other.",
+    )
+
+    parser.add_argument(
+        '-n', '--repeat',
+        type=int,
+        default=3,
+        help="Keep the best of this many runs.",
+    )
+
+    parser.add_argument(
+        '--builds',
+        action='store_true',
+        help="Time a compiled indently.lib against the pure Python one.",
+    )
+
+    parser.add_argument(
+        '--latency',
+        action='store_true',
+        help="Time how long formatting takes after each of a series of "
+             "small edits, like an editor would see it.",
+    )
+
+    parser.add_argument(
+        '--edits',
+        type=int,
+        default=20,
+        help="How many edits --latency makes to each file.",
+    )
+
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help="Seed for picking where --latency makes its edits.",
+    )
+
+    parser.add_argument(
+        'source',
+        type=argparse.FileType(),
+        nargs='+',
+        help="Python source files to use as the corpus.",
+    )
+
+    return parser.parse_args(args)
+
+
+def best_of(repeat, func):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def compare_tokenizers(corpus, repeat=3):
+    results = []
+
+    for name, tokenize_source in sorted(indently.lib.TOKENIZERS.items()):
+        def tokenize_corpus():
+            for source in corpus:
+                for _ in tokenize_source(source):
+                    pass
+
+        def format_corpus():
+            return [
+                indently.lib.format_source_code(source, tokenizer=name)
+                for source in corpus
+            ]
+
+        results.append((
+            name,
+            best_of(repeat, tokenize_corpus),
+            best_of(repeat, format_corpus),
+            format_corpus(),
+        ))
+
+    return results
+
+
+def is_compiled(lib):
+    return os.path.splitext(lib.__file__)[1] not in ('.py', '.pyc')
+
+
+def load_pure_lib():
+    # the lib.py that always gets installed next to a compiled one
+    return imp.load_source(
+        'indently._pure_lib',
+        os.path.splitext(indently.lib.__file__)[0] + '.py',
+    )
+
+
+def compare_builds(corpus, repeat=3):
+    results = []
+
+    for name, lib in [
+        ('compiled', indently.lib),
+        ('pure', load_pure_lib()),
+    ]:
+        def format_corpus():
+            return [lib.format_source_code(source) for source in corpus]
+
+        results.append((name, best_of(repeat, format_corpus), format_corpus()))
+
+    return results
+
+
+def main_builds(args, corpus):
+    if not is_compiled(indently.lib):
+        sys.exit("indently.lib isn't compiled, reinstall with "
+                 "INDENTLY_CYTHON=1 to build it")
+
+    results = compare_builds(corpus, args.repeat)
+    num_bytes = sum(len(source) for source in corpus)
+
+    print '%d files, %d bytes' % (len(corpus), num_bytes)
+    print '%-10s %12s %10s' % ('build', 'format (s)', 'KB/s')
+
+    for name, format_time, _ in results:
+        print '%-10s %12.4f %10.1f' % (
+            name,
+            format_time,
+            num_bytes / 1024.0 / format_time,
+        )
+
+    outputs = [output for _, _, output in results]
+    if any(output != outputs[0] for output in outputs):
+        print 'warning: builds disagree on some files'
+
+
+# calls with nothing nested in them, where we can add arguments to
+call_matcher = re.compile(r'\w\(([^()\'"#\n]*)\)')
+
+
+def add_argument(source_code, rand, argument):
+    calls = list(call_matcher.finditer(source_code))
+    if not calls:
+        return source_code
+
+    call = rand.choice(calls)
+    if call.group(1).strip():
+        argument = ', ' + argument
+
+    return source_code[:call.end(1)] + argument + source_code[call.end(1):]
+
+
+def add_comment(source_code, rand):
+    # on the end of a line of code, well clear of strings and comments
+    lines = source_code.splitlines(True)
+    candidates = [
+        idx for idx, line in enumerate(lines)
+        if line.strip() and not re.search(r'[\'"#\\]', line)
+    ]
+    if not candidates:
+        return source_code
+
+    idx = rand.choice(candidates)
+    lines[idx] = lines[idx].rstrip() + '  # ' + ' '.join(
+        ['note'] * rand.randint(1, 20)
+    ) + '\n'
+
+    return ''.join(lines)
+
+
+# the sort of thing somebody types in between saves
+EDITS = {
+    'argument': lambda source_code, rand: add_argument(
+        source_code,
+        rand,
+        'x',
+    ),
+    'lengthen': lambda source_code, rand: add_argument(
+        source_code,
+        rand,
+        'a_rather_long_keyword_argument=some_rather_long_value',
+    ),
+    'comment': add_comment,
+}
+
+
+def whole_file_mode():
+    return indently.lib.format_source_code, lambda: None
+
+
+def incremental_mode():
+    # like --watch with --cache: only the statements that changed get laid
+    # out again
+    statements = indently.lib.StatementCache()
+
+    def format_source(source_code):
+        return indently.lib.format_source_code(
+            source_code,
+            cache=indently.lib.LayoutCache(statements),
+        )
+
+    return format_source, lambda: None
+
+
+def daemon_mode():
+    # a long running formatter (like an editor plugin would talk to) that
+    # keeps its layouts around between requests
+    executor = indently.executor.FormatExecutor(workers=1)
+    statements = indently.lib.StatementCache()
+
+    def format_source(source_code):
+        return executor.format(
+            source_code,
+            cache=indently.lib.LayoutCache(statements),
+        ).result()
+
+    return format_source, executor.close
+
+
+LATENCY_MODES = [
+    ('whole-file', whole_file_mode),
+    ('incremental', incremental_mode),
+    ('daemon', daemon_mode),
+]
+
+
+def replay_edits(corpus, format_source, edits=20, seed=0):
+    # every mode gets the same edits, in the same places. each one is made
+    # to the formatted result of the last, same as in an editor.
+    rand = random.Random(seed)
+    times = []
+
+    for source_code in corpus:
+        source_code = format_source(source_code)
+
+        for _ in xrange(edits):
+            edit = EDITS[rand.choice(sorted(EDITS))]
+            edited = edit(source_code, rand)
+
+            start = timeit.default_timer()
+            source_code = format_source(edited)
+            times.append(timeit.default_timer() - start)
+
+    return times
+
+
+def percentile(times, percent):
+    # nearest rank, so it's always a time we actually measured
+    ordered = sorted(times)
+    rank = int(math.ceil(percent / 100.0 * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
+
+def compare_latencies(corpus, edits=20, seed=0):
+    results = []
+
+    for name, make_mode in LATENCY_MODES:
+        format_source, close = make_mode()
+        try:
+            times = replay_edits(corpus, format_source, edits, seed)
+        finally:
+            close()
+
+        results.append((name, times))
+
+    return results
+
+
+def main_latency(args, corpus):
+    results = compare_latencies(corpus, args.edits, args.seed)
+
+    print '%d files, %d edits each' % (len(corpus), args.edits)
+    print '%-12s %10s %10s %10s' % ('mode', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)')
+
+    for name, times in results:
+        print '%-12s %10.1f %10.1f %10.1f' % (
+            name,
+            percentile(times, 50) * 1000,
+            percentile(times, 95) * 1000,
+            percentile(times, 99) * 1000,
+        )
+
+
+def main():
+    args = parse_args()
+
+    corpus = [f.read() for f in args.source]
+
+    if args.builds:
+        main_builds(args, corpus)
+        return
+
+    if args.latency:
+        main_latency(args, corpus)
+        return
+    num_bytes = sum(len(source) for source in corpus)
+
+    results = compare_tokenizers(corpus, args.repeat)
+
+    print '%d files, %d bytes' % (len(corpus), num_bytes)
+    print '%-10s %12s %12s %10s' % (
+        'tokenizer',
+        'tokenize (s)',
+        'format (s)',
+        'KB/s',
+    )
+
+    for name, tokenize_time, format_time, _ in results:
+        print '%-10s %12.4f %12.4f %10.1f' % (
+            name,
+            tokenize_time,
+            format_time,
+            num_bytes / 1024.0 / format_time,
+        )
+
+    outputs = [output for _, _, _, output in results]
+    if any(output != outputs[0] for output in outputs):
+        print 'warning: tokenizers disagree on some files'
+
+
+if __name__ == '__main__':
+    main()
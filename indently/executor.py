@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import collections
+import itertools
+import multiprocessing
+import multiprocessing.pool
+import threading
+import time
+
+import indently.lib
+
+
+class FormatTimeout(Exception):
+    pass
+
+
+class FormatCancelled(Exception):
+    pass
+
+
+def _format(source_code, options, deadline=None):
+    # nobody's waiting on a job that sat in the queue past its deadline, so
+    # don't bother starting it
+    if deadline is not None and time.time() > deadline:
+        return False, FormatTimeout()
+
+    # exceptions don't make it back through apply_async's callback, so hand
+    # them back as values instead.
+    try:
+        return True, indently.lib.format_source_code(source_code, **options)
+    except Exception as e:
+        return False, e
+
+
+def _format_unless_cancelled(future, source_code, options):
+    if future.cancelled:
+        return False, FormatCancelled()
+    return _format(source_code, options, future.deadline)
+
+
+class FormatFuture(object):
+
+    def __init__(self, timeout=None):
+        self.deadline = None if timeout is None else time.time() + timeout
+        self.cancelled = False
+
+        self._outcome = None
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def done(self):
+        return self.cancelled or self._done.is_set()
+
+    def cancel(self):
+        # a worker can't be interrupted once it starts, but thread workers
+        # won't start on a cancelled job, and nobody has to wait for it.
+        if self._done.is_set():
+            return False
+
+        self.cancelled = True
+        self._set_outcome((False, FormatCancelled()))
+
+        return True
+
+    def add_done_callback(self, callback):
+        # callbacks run on a pool thread; event loops should hop back onto
+        # their own thread from there (e.g. IOLoop.add_callback).
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+
+        callback(self)
+
+    def result(self, timeout=None):
+        wait = timeout
+        if self.deadline is not None:
+            remaining = max(0, self.deadline - time.time())
+            wait = remaining if wait is None else min(wait, remaining)
+
+        if not self._done.wait(wait):
+            raise FormatTimeout()
+
+        ok, value = self._outcome
+        if not ok:
+            raise value
+
+        return value
+
+    def _set_outcome(self, outcome):
+        with self._lock:
+            if self._done.is_set():
+                return
+            self._outcome = outcome
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for callback in callbacks:
+            callback(self)
+
+
+class FormatExecutor(object):
+
+    def __init__(self, workers=None, processes=False):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.processes = processes
+
+        # the pool size is what keeps one huge file from hogging everything,
+        # it only ever ties up one worker.
+        if processes:
+            self.pool = multiprocessing.Pool(self.workers)
+        else:
+            self.pool = multiprocessing.pool.ThreadPool(self.workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def format(self, source_code, timeout=None, **options):
+        future = FormatFuture(timeout)
+
+        # the timeout is for the work too, not just for whoever's waiting on
+        # it: statements still left once it's up are left as they were. it
+        # runs from now, not from whenever a worker gets to the job.
+        if timeout is not None and options.get('budget') is None:
+            options['budget'] = indently.lib.Budget(deadline=future.deadline)
+
+        if self.processes:
+            func, args = _format, (source_code, options, future.deadline)
+        else:
+            func = _format_unless_cancelled
+            args = (future, source_code, options)
+
+        self.pool.apply_async(func, args, callback=future._set_outcome)
+
+        return future
+
+    def format_many(self, sources, timeout=None, window=None, **options):
+        # only a window of sources is handed out at a time, so a long (or
+        # endless) iterable doesn't all end up queued. whatever's still out
+        # gets cancelled if we fail, or if nobody wants the rest.
+        window = window or self.workers * 2
+        sources = iter(sources)
+
+        def submit(count):
+            for source_code in itertools.islice(sources, count):
+                futures.append(
+                    self.format(source_code, timeout=timeout, **options)
+                )
+
+        futures = collections.deque()
+        submit(window)
+
+        try:
+            while futures:
+                result = futures.popleft().result()
+                submit(1)
+                yield result
+        finally:
+            for future in futures:
+                future.cancel()
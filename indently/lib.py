@@ -1,9 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import bisect
+import hashlib
 import itertools
+import keyword
+import marshal
 import os
 import re
+import StringIO
+import tempfile
 import textwrap
+import time
+import tokenize
 
 LINE_LEN = 79
 
@@ -44,60 +52,58 @@ class Comment(Token):
 
 
 class Code(Token):
-    pass
 
+    @property
+    def subtokens(self):
+        # split up lazily, most code never needs looking at this closely
+        if not hasattr(self, '_subtokens'):
+            self._subtokens = list(scan_code(self.value, self.offset))
+        return self._subtokens
 
-class SourceTransformer(object):
 
-    def __init__(self, source, transforms=None, dr_dre=None):
-        self.source = source
-        self.transforms = transforms or []
+class Whitespace(Token):
+    pass
 
-        # "let me through i'm a doctor!" says dr dre as he pushes through the
-        # crowd & kneels beside the sick man. "this man is dying of no rap
-        # songs"
-        self.dr_dre = dr_dre or 128169
 
-        try:
-            unichr(self.dr_dre)
-        except ValueError:  # narrow python build, forget about dre.
-            self.dr_dre = 1000
+class Name(Token):
+    pass
 
-    def transform(self, idx, old, new):
-        # should assert old exists at idx...
 
-        butt_ninja = unichr(self.dr_dre) * len(old)
+class Keyword(Token):
+    pass
 
-        new_source = self.source[:idx] + butt_ninja + self.source[
-            idx + len(old):
-        ]
 
-        return SourceTransformer(
-            new_source,
-            transforms=self.transforms + [(butt_ninja, new)],
-            dr_dre=self.dr_dre + 1,
-        )
+class Operator(Token):
+    pass
 
-    def result(self):
-        result = self.source
 
-        for butt_ninja, new in self.transforms:
-            result = result.replace(butt_ninja, new)
+code_scanner = re.compile(r'(\s+)|(\w+)|(.)', re.DOTALL)
 
-        return result
 
+def scan_code(code, offset=0):
+    for match in code_scanner.finditer(code):
+        whitespace, word, operator = match.groups()
+        if whitespace:
+            yield Whitespace(whitespace, offset + match.start())
+        elif word and keyword.iskeyword(word):
+            yield Keyword(word, offset + match.start())
+        elif word:
+            yield Name(word, offset + match.start())
+        else:
+            yield Operator(operator, offset + match.start())
 
-def parse_code(source_code):
 
+def parse_code(source_code):
+    # the token so far is always source_code[begin:offset + 1]. slicing it
+    # out when it's done beats adding on a char at a time, which CPython
+    # gets away with but a compiled build copies every time.
     begin = 0
     offset = 0
-    current_line = ''
     string_context = []
     in_string = False
 
     while offset < len(source_code):
         char = source_code[offset]
-        current_line += char
         in_string = bool(string_context)
 
         if not in_string and char == '#':
@@ -108,14 +114,13 @@ def parse_code(source_code):
                 # the last line is a comment, nothing left to do
                 comment_end = len(source_code) - 1
 
-            if current_line[:-1]:
-                yield Code(current_line[:-1], begin)
+            if offset > begin:
+                yield Code(source_code[begin:offset], begin)
 
             yield Comment(source_code[offset:comment_end + 1], offset)
 
             begin = comment_end + 1
             offset = comment_end + 1
-            current_line = ""
 
             continue
 
@@ -129,23 +134,18 @@ def parse_code(source_code):
                 or source_code[offset - 2:offset] == "\\\\"
             )
         ):
-            # look ahead and see if we're closing a 3-quote string
+            # look ahead and see if we're closing a 3-quote string, and skip
+            # over the rest of its quotes if so.
             if (
                 source_code[offset:offset + len(string_context[-1])] == string_context[
                     -1
                 ]
             ):
-                # if it is a 3-quote string, add those remaining 2 quotes to
-                # the current line. otherwise this a no-op.
-                num_closing_chars = len(string_context.pop())
-                if num_closing_chars == 3:
-                    current_line = current_line[:-1] + current_line[-1] * 3
-                offset += num_closing_chars - 1
+                offset += len(string_context.pop()) - 1
 
             if not string_context:
-                yield String(current_line, begin)
+                yield String(source_code[begin:offset + 1], begin)
                 begin = offset + 1
-                current_line = ''
 
         elif not in_string and char in ('"', "'"):
             if source_code[offset:offset + 3] in ('"""', "'''"):
@@ -153,27 +153,83 @@ def parse_code(source_code):
             else:
                 string_context.append(char)
 
-            if current_line[:-1]:
-                yield Code(current_line[:-1], begin)
+            if offset > begin:
+                yield Code(source_code[begin:offset], begin)
 
             begin = offset
-            current_line = char
 
         offset += 1
 
-    if in_string and current_line:
-        yield String(current_line, begin)
-    elif current_line:
-        yield Code(current_line, begin)
+    if in_string and begin < len(source_code):
+        yield String(source_code[begin:], begin)
+    elif begin < len(source_code):
+        yield Code(source_code[begin:], begin)
+
+
+def parse_code_tokenize(source_code):
+    try:
+        tokens = list(_parse_code_tokenize(source_code))
+    except (tokenize.TokenError, IndentationError):
+        # tokenize only understands whole statements, leave fragments to the
+        # hand-written parser.
+        tokens = list(parse_code(source_code))
+
+    return iter(tokens)
+
+
+def _parse_code_tokenize(source_code):
+    line_starts = [0] + [
+        match.end()
+        for match in re.finditer(re.escape(os.linesep), source_code)
+    ]
+
+    begin = 0
+    tokens = tokenize.generate_tokens(StringIO.StringIO(source_code).readline)
+
+    for kind, value, (row, col), (end_row, end_col), _ in tokens:
+        if kind not in (tokenize.STRING, tokenize.COMMENT):
+            continue
+
+        start = line_starts[row - 1] + col
+
+        if kind == tokenize.STRING:
+            # parse_code leaves u'' and r'' prefixes with the code
+            start += len(value) - len(value.lstrip('uUbBrR'))
+            end = line_starts[end_row - 1] + end_col
+        else:
+            # while comments hold on to their newline
+            end = source_code.find(os.linesep, start) + 1 or len(source_code)
+
+        if begin < start:
+            yield Code(source_code[begin:start], begin)
+
+        if kind == tokenize.STRING:
+            yield String(source_code[start:end], start)
+        else:
+            yield Comment(source_code[start:end], start)
+
+        begin = end
+
+    if begin < len(source_code):
+        yield Code(source_code[begin:], begin)
+
+
+TOKENIZERS = {
+    'native': parse_code,
+    'tokenize': parse_code_tokenize,
+}
 
 
-def find_outer_brackets(source_code):
+def find_outer_brackets(source_code, tokens=None):
     if not any(start_char in source_code for start_char in start_chars):
         return
 
+    if tokens is None:
+        tokens = parse_code(source_code)
+
     seen_brackets = []
 
-    for token in (t for t in parse_code(source_code) if isinstance(t, Code)):
+    for token in (t for t in tokens if isinstance(t, Code)):
         for idx, char in enumerate(token.value):
             if char in start_chars:
                 assert source_code[token.offset + idx] == char, token
@@ -205,45 +261,141 @@ def indent_at(source_code, loc):
     return spaces * ' '
 
 
+# directives are comments on a line of their own, outside of any brackets
+directive_matcher = re.compile(r'#\s*indently:\s*(off|on|skip-file)\s*$')
+
+
+def find_directives(source_code, tokens=None):
+    # yields (directive, start of its line, end of its line)
+    if 'indently:' not in source_code:
+        return
+
+    if tokens is None:
+        tokens = parse_code(source_code)
+
+    depth = 0
+
+    for token in tokens:
+        if isinstance(token, Code):
+            for char in token.value:
+                if char in start_chars:
+                    depth += 1
+                elif char in end_chars:
+                    depth -= 1
+            continue
+
+        if not isinstance(token, Comment) or depth:
+            continue
+
+        match = directive_matcher.match(token.value)
+        if not match:
+            continue
+
+        line_start = token.offset - horizontal_location(
+            source_code,
+            token.offset,
+        )
+        if source_code[line_start:token.offset].strip():
+            continue
+
+        yield match.group(1), line_start, token.offset + len(token.value)
+
+
+def split_regions(source_code, tokenizer='native'):
+    # yields (start, end, skip) covering the whole source. skipped regions
+    # run from an "# indently: off" line through the "# indently: on" line
+    # that ends it, and "# indently: skip-file" skips the lot.
+    tokens = None
+    if 'indently:' in source_code:
+        tokens = TOKENIZERS[tokenizer](source_code)
+
+    last = 0
+    off = None
+
+    for directive, line_start, line_end in find_directives(
+        source_code,
+        tokens,
+    ):
+        if directive == 'skip-file':
+            yield 0, len(source_code), True
+            return
+
+        if directive == 'off' and off is None:
+            off = line_start
+        elif directive == 'on' and off is not None:
+            if off > last:
+                yield last, off, False
+            yield off, line_end, True
+            last = line_end
+            off = None
+
+    if off is not None:
+        if off > last:
+            yield last, off, False
+        yield off, len(source_code), True
+    elif last < len(source_code) or not last:
+        yield last, len(source_code), False
+
+
+# headers tools put on the files they write, which we leave alone. only the
+# well known ones, and only in comments: a docstring or a TODO that talks
+# about generated code doesn't make the file generated.
+generated_matcher = re.compile(
+    r'@generated\b|\bDO NOT EDIT\b|\bGenerated by Django\b'
+    r'|\bGenerated by the protocol buffer compiler\b'
+)
+
+
+def looks_generated(header, lines=5):
+    return any(
+        line.lstrip().startswith('#') and generated_matcher.search(line)
+        for line in header.split(os.linesep)[:lines]
+    )
+
+
 def extract_args(bracket_body):
 
     args = []
     current_line = ""
 
-    start_stops = list(find_outer_brackets(' ' + bracket_body[1:-1]))
+    tokens = list(parse_code(bracket_body[1:-1]))
 
-    in_comprehension = any(
-        ' for ' in t.value
-        for t in parse_code(bracket_body[1:-1])
-        if isinstance(t, Code) and not any(
-            start <= t.offset < stop
-            for start, stop in start_stops
-        )
-    )
+    # we're a comprehension if there's a "for" out in the open
+    depth = 0
+    in_comprehension = False
+    for token in tokens:
+        if isinstance(token, Code):
+            if not depth and ' for ' in token.value:
+                in_comprehension = True
+                break
+            depth += sum(token.value.count(char) for char in start_chars)
+            depth -= sum(token.value.count(char) for char in end_chars)
 
     def add_arg(arg):
         thin_arg = ''
         for t in parse_code(arg):
             if isinstance(t, Code):
                 thin_arg += re.sub('\s+', ' ', t.value)
+                continue
+
             # join long strings
-            elif (
+            stripped = thin_arg.rstrip(' \t\n\r\f\v')
+            if (
                 isinstance(t, String)
                 and not t.verbatim
-                and re.search('["\']\s+$', thin_arg)
-                and re.search('["\']\s+$', thin_arg).group()[0] == t.value[0]
+                and stripped != thin_arg
+                and stripped[-1:] in ('"', "'")
+                and stripped[-1] == t.value[0]
+                and not stripped.endswith(('"""', "'''"))
             ):
-                thin_arg = thin_arg[
-                    :-len(re.search('["\']\s+$', thin_arg).group())
-                ] + t.value[
-                    1:
-                ]
+                thin_arg = stripped[:-1] + t.value[1:]
             else:
                 thin_arg += t.value.strip()
 
         args.append(thin_arg)
 
-    for token in parse_code(bracket_body[1:-1]):
+    depth = 0
+    for token in tokens:
         if isinstance(token, Comment):
             add_arg(token.value)
             continue
@@ -252,43 +404,51 @@ def extract_args(bracket_body):
             current_line += token.value
             continue
 
-        for idx, char in enumerate(token.value):
-            in_bracket = any(
-                start <= token.offset + idx < stop
-                for start, stop in start_stops
+        subtokens = token.subtokens
+        for idx, sub in enumerate(subtokens):
+            if sub.value in start_chars:
+                depth += 1
+            elif sub.value in end_chars:
+                depth -= 1
+
+            following = subtokens[idx + 1:idx + 3]
+            splits_before = (
+                isinstance(sub, Whitespace)
+                and len(following) == 2
+                and isinstance(following[0], Keyword)
+                and isinstance(following[1], Whitespace)
             )
 
-            if not in_bracket and not in_comprehension and (char == ','):
+            if depth or (not splits_before and sub.value != ','):
+                current_line += sub.value
+
+            elif not in_comprehension and sub.value == ',':
                 if current_line.strip():
-                    add_arg(current_line.strip() + char)
+                    add_arg(current_line.strip() + sub.value)
                     current_line = ""
-            elif (
-                not in_bracket
-                and not in_comprehension
-                and (
-                    re.match(r'^\s+and\s+', token.value[idx:])
-                    or re.match(r'^\s+or\s+', token.value[idx:])
-                    or re.match(r'^\s+else\s+', token.value[idx:])
-                    or re.match(r'^\s+if\s+', token.value[idx:])
-                )
+
+            elif not in_comprehension and following[0].value in (
+                'and',
+                'or',
+                'else',
+                'if',
             ):
                 if current_line.strip():
                     add_arg(current_line.strip())
                     current_line = ""
 
             elif (
-                not in_bracket
-                and in_comprehension
-                and (
-                    token.value[idx:idx+5] == ' for '
-                    or token.value[idx:idx+4] == ' if '
-                )
+                in_comprehension
+                and splits_before
+                and following[0].value in ('for', 'if')
+                and sub.value[-1] == ' '
+                and following[1].value[0] == ' '
             ):
-                add_arg(current_line.strip())
+                add_arg((current_line + sub.value[:-1]).strip())
                 current_line = ""
 
             else:
-                current_line += char
+                current_line += sub.value
 
     if current_line.strip():
         add_arg(current_line.strip())
@@ -378,51 +538,1092 @@ def destroy_backslashes(token_stream):
             yield next_next
 
 
-def format_source_code(source_code):
-    x = ''.join(t.value for t in destroy_backslashes(parse_code(source_code)))
-    formatted_source =_format_source_code(x or source_code)
-    return _wrap_long_comments(formatted_source)
+def format_source_code(source_code, layout='greedy', tokenizer='native',
+                       budget=None, pool=None, cache=None):
+    return format_edits(
+        source_code,
+        layout,
+        tokenizer,
+        budget,
+        pool,
+        cache,
+    )[0]
+
+
+# roughly how many bytes of layouts and results format_many holds on to
+# before it starts over, so a long run can't eat all our memory.
+FORMAT_MANY_CACHE_BYTES = 32 * 1024 * 1024
+
+
+def format_many(sources, layout='greedy', tokenizer='native', pool=None,
+                cache=None):
+    # formats each source in turn, yielding (formatted source, changed). the
+    # layouts worked out for one source are there for the next, and a source
+    # we've seen before isn't formatted again.
+    if cache is None:
+        cache = LayoutCache()
+
+    # keyed by digest, so we don't hang on to every source we're given
+    results = {}
+    results_bytes = 0
+
+    for source_code in sources:
+        digest = _digest(source_code)
+
+        if digest not in results:
+            if cache.bytes + results_bytes > FORMAT_MANY_CACHE_BYTES:
+                cache.clear()
+                results.clear()
+                results_bytes = 0
+
+            formatted_source, edits = format_edits(
+                source_code,
+                layout,
+                tokenizer,
+                pool=pool,
+                cache=cache,
+            )
+            results[digest] = formatted_source, bool(edits)
+            results_bytes += len(formatted_source)
 
+        yield results[digest]
 
-def _format_source_code(source_code, indent=''):
-    xformer = SourceTransformer(source_code)
 
-    # really need to make this work in-place
-    for start, stop in find_outer_brackets(source_code):
-        old_bracket = source_code[start:stop+1]
-        new_bracket = rewrite_bracket(
-            old_bracket,
-            indent + indent_at(source_code, start),
-            len(indent) + horizontal_location(source_code, start),
-        )
+def format_edits(source_code, layout='greedy', tokenizer='native',
+                 budget=None, pool=None, cache=None):
+    # returns the formatted source, along with the edits that take us there
+    # from the original.
+    pieces = []
+    edits = []
 
-        xformer = xformer.transform(start, old_bracket, new_bracket)
+    for start, end, skip in split_regions(source_code, tokenizer):
+        if skip:
+            pieces.append(source_code[start:end])
+            continue
 
-    # if we didn't do anything, see if we can parenthesize long strings and
-    # wrap them.
-    if xformer.result() == source_code:
-        for token in parse_code(source_code):
-            if (
-                isinstance(token, String)
-                # base case terminates
-                and not token.verbatim
-                and len(token.value) + len(
-                    indent_at(source_code, token.offset)
-                ) > LINE_LEN
-                and token.offset < LINE_LEN - 10
-                and source_code != token.value
+        piece, piece_edits = _format_edits(
+            source_code[start:end],
+            layout,
+            tokenizer,
+            budget,
+            pool,
+            cache,
+        )
+        pieces.append(piece)
+        edits.extend(
+            (edit_start + start, edit_end + start, replacement)
+            for edit_start, edit_end, replacement in piece_edits
+        )
+
+    return ''.join(pieces), edits
+
+
+def _format_edits(source_code, layout='greedy', tokenizer='native',
+                  budget=None, pool=None, cache=None):
+    # every pass works off the same buffer, so each one only has to scan
+    # whatever the passes before it changed.
+    buffer = EditBuffer(source_code, tokenizer)
+
+    buffer.apply(_backslash_edits(buffer.source_code, buffer.tokens))
+
+    buffer.apply(LAYOUTS[layout](
+        buffer.source_code,
+        tokenizer=tokenizer,
+        budget=budget,
+        pool=pool,
+        cache=cache,
+        tokens=buffer.tokens,
+    ))
+
+    buffer.apply(_long_comment_edits(buffer.source_code, buffer.tokens))
+
+    return buffer.source_code, minimal_edits(source_code, buffer.edits)
+
+
+def iter_format_source_code(source_code, layout='greedy', tokenizer='native',
+                            budget=None, pool=None, cache=None):
+    # same as format_source_code, but handed back a piece at a time as each
+    # top level statement is finished, so nobody has to wait for the end of
+    # a big file to get going.
+    for start, end, skip in split_regions(source_code, tokenizer):
+        piece = source_code[start:end]
+
+        if skip:
+            yield piece
+        elif layout != 'greedy':
+            yield _format_edits(
+                piece,
+                layout,
+                tokenizer,
+                budget,
+                pool,
+                cache,
+            )[0]
+        else:
+            for chunk in _iter_format_greedy(
+                piece,
+                tokenizer,
+                budget,
+                pool,
+                cache,
             ):
-                return _format_source_code(
-                    source_code.replace(token.value, '(' + token.value + ')')
-                )
+                yield chunk
+
+
+def _iter_format_greedy(source_code, tokenizer, budget, pool, cache):
+    tokenize_source = TOKENIZERS[tokenizer]
+
+    buffer = EditBuffer(source_code, tokenizer)
+    buffer.apply(_backslash_edits(buffer.source_code, buffer.tokens))
+
+    string_edits, parenthesized, brackets, tokens = _plan_layout(
+        buffer.source_code,
+        tokenizer,
+        buffer.tokens,
+    )
+    added_parens = _added_parens(string_edits)
+
+    # we can only cut on a line break that isn't in a string or a bracket,
+    # that way each piece tokenizes the same as it would have in place.
+    cuts = []
+    depth = 0
+    for token in (t for t in tokens if isinstance(t, Code)):
+        for idx, char in enumerate(token.value):
+            if char in start_chars:
+                depth += 1
+            elif char in end_chars:
+                depth -= 1
+            elif char == os.linesep[-1] and not depth:
+                cuts.append(token.offset + idx + 1)
+
+    pending = []
+    held = ''
+    emitted = 0
+    last = 0
+
+    new_brackets = _layout_brackets(brackets, budget, pool, cache)
+    for (start, stop, key), new_bracket in itertools.izip(
+        brackets,
+        new_brackets,
+    ):
+        # everything up to this bracket is done
+        idx = bisect.bisect_right(cuts, start)
+        cut = cuts[idx - 1] if idx else 0
+        if cut > emitted:
+            pending.append(parenthesized[last:cut])
+            done, held = _finish_piece(
+                held + ''.join(pending),
+                tokenize_source,
+            )
+            if done:
+                yield done
+            pending = []
+            emitted = last = cut
+
+        pending.append(parenthesized[last:start])
+        pending.append(_unless_skipped(new_bracket, start, key, added_parens))
+        last = stop + 1
+
+    pending.append(parenthesized[last:])
+    yield _finish_piece(
+        held + ''.join(pending),
+        tokenize_source,
+        last=True,
+    )[0]
+
+
+# wraps the comments in a finished piece, the same as the comment pass would
+# have over the whole file. the cuts are all outside strings to begin with,
+# but laying a bracket out can leave a string open (see split_string), and
+# then the whole file scans as still being in it past the cut. so if a piece
+# ends in a string, we hand it back to be scanned again with the next piece.
+def _finish_piece(piece, tokenize_source, last=False):
+    tokens = list(tokenize_source(piece))
+
+    end = len(piece)
+    if not last and tokens and isinstance(tokens[-1], String):
+        end = tokens.pop().offset
+
+    return (
+        _apply_edits(piece[:end], _long_comment_edits(piece, tokens)),
+        piece[end:],
+    )
+
+
+def apply_edits(source_code, edits):
+    last = 0
+    for start, end, _ in edits:
+        if not last <= start <= end <= len(source_code):
+            raise ValueError(
+                'edits need to be sorted, non-overlapping, and fit in the '
+                'source: %r' % ((start, end),)
+            )
+        last = end
+
+    return _apply_edits(source_code, edits)
+
+
+def minimal_edits(source_code, edits):
+    # trims off whatever each edit leaves the same at either end, and drops
+    # the ones that don't change anything at all (like the ones left behind
+    # by a statement we gave up on).
+    trimmed = []
+
+    for start, end, replacement in edits:
+        old = source_code[start:end]
+
+        prefix = _common_prefix_length(old, 0, replacement, 0)
+        suffix = _common_prefix_length(
+            old[prefix:][::-1], 0,
+            replacement[prefix:][::-1], 0,
+        )
+
+        start, end = start + prefix, end - suffix
+        replacement = replacement[prefix:len(replacement) - suffix]
+        if start < end or replacement:
+            trimmed.append((start, end, replacement))
+
+    return trimmed
+
+
+# edits are sorted, non-overlapping (start, end, replacement) tuples
+def _apply_edits(source_code, edits):
+    if not edits:
+        return source_code
+
+    pieces = []
+    last = 0
+
+    for start, end, replacement in edits:
+        pieces.append(source_code[last:start])
+        pieces.append(replacement)
+        last = end
+
+    pieces.append(source_code[last:])
+
+    return ''.join(pieces)
+
+
+def _compose_edits(first, second, middle):
+    # first takes us from a to middle, second from middle to c. we want the
+    # edits that take us from a to c.
+    if not first or not second:
+        return list(first or second)
+
+    # where first's replacements ended up in middle, and how much each of
+    # them moved things along.
+    landed = []
+    ends = []
+    shifts = [0]
+    for start, end, replacement in first:
+        landed.append(start + shifts[-1])
+        ends.append(end)
+        shifts.append(shifts[-1] + len(replacement) - (end - start))
+
+    def to_a(pos):
+        idx = bisect.bisect_right(landed, pos) - 1
+        if idx < 0:
+            return pos, pos
+
+        start, end, replacement = first[idx]
+        if pos >= landed[idx] + len(replacement):
+            return pos - shifts[idx + 1], pos - shifts[idx + 1]
+
+        # somewhere in the middle of one of first's replacements
+        return start, end
+
+    # everything either pass touched, in a's coordinates. touching ranges get
+    # merged so the ends of a cluster map cleanly onto middle.
+    ranges = sorted(
+        [(start, end) for start, end, _ in first] + [
+            (to_a(start)[0], to_a(end)[1])
+            for start, end, _ in second
+        ]
+    )
+
+    clusters = []
+    for start, end in ranges:
+        if clusters and start <= clusters[-1][1]:
+            clusters[-1][1] = max(end, clusters[-1][1])
+        else:
+            clusters.append([start, end])
+
+    edits = []
+    idx = 0
+    for start, end in clusters:
+        middle_start = start + shifts[bisect.bisect_left(ends, start)]
+        middle_end = end + shifts[bisect.bisect_right(ends, end)]
+
+        inner = []
+        while idx < len(second) and (
+            second[idx][0] < middle_end
+            or second[idx][0] == second[idx][1] == middle_end
+        ):
+            edit_start, edit_end, replacement = second[idx]
+            inner.append((
+                edit_start - middle_start,
+                edit_end - middle_start,
+                replacement,
+            ))
+            idx += 1
+
+        edits.append((
+            start,
+            end,
+            _apply_edits(middle[middle_start:middle_end], inner),
+        ))
+
+    return edits
+
+
+def _common_prefix_length(a, i, b, j):
+    n = min(len(a) - i, len(b) - j)
+
+    # gallop until we overshoot the first mismatch, then narrow it down
+    lo = 0
+    step = 64
+    while True:
+        hi = min(n, lo + step)
+        if a[i + lo:i + hi] != b[j + lo:j + hi]:
+            break
+        if hi == n:
+            return n
+        lo = hi
+        step *= 2
+
+    while lo + 1 < hi:
+        mid = (lo + hi) // 2
+        if a[i + lo:i + mid] == b[j + lo:j + mid]:
+            lo = mid
+        else:
+            hi = mid
+
+    return lo
+
+
+def _deletion_edits(source_code, subsequence):
+    # destroy_backslashes only ever deletes things, so we can recover its
+    # edits by lining the two up.
+    if source_code == subsequence:
+        return []
+
+    edits = []
+    i = j = 0
+
+    while j < len(subsequence):
+        matched = _common_prefix_length(source_code, i, subsequence, j)
+        i += matched
+        j += matched
+
+        if j == len(subsequence):
+            break
+
+        # skip ahead to where we pick up again. prefer somewhere that keeps on
+        # matching for a while, so one deleted run doesn't get chopped up.
+        start = i
+        ahead = subsequence[j:j + 16]
+        i = source_code.find(ahead, start)
+        if i == -1:
+            i = source_code.find(subsequence[j], start)
+        if i == -1:  # not a subsequence after all, replace the lot
+            return [(0, len(source_code), subsequence)]
+
+        edits.append((start, i, ''))
+
+    if i < len(source_code):
+        edits.append((i, len(source_code), ''))
+
+    return edits
+
+
+def _backslash_edits(source_code, tokens):
+    return _deletion_edits(source_code, ''.join(
+        t.value for t in destroy_backslashes(iter(tokens))
+    ) or source_code)
+
+
+# the tokenize backend hands the whole source over to parse_code if any of it
+# doesn't tokenize, so its tokens for one piece depend on all the rest.
+INCREMENTAL_TOKENIZERS = set(['native'])
+
+
+# a source along with its tokens, for passes that each edit it in turn. the
+# edits that get applied are kept (against the original source), and only the
+# tokens they touched get scanned again, the next time somebody asks for them.
+class EditBuffer(object):
+
+    def __init__(self, source_code, tokenizer='native', tokens=None):
+        self.source_code = source_code
+        self.edits = []
+
+        self._tokenize = TOKENIZERS[tokenizer]
+        self._incremental = tokenizer in INCREMENTAL_TOKENIZERS
+        self._tokens = None if tokens is None else list(tokens)
+        self._stale = None  # (old source, old tokens, edits since)
+
+    @property
+    def tokens(self):
+        if self._stale is not None:
+            self._tokens = _rescan(*self._stale + (self._tokenize,))
+            self._stale = None
+        elif self._tokens is None:
+            self._tokens = list(self._tokenize(self.source_code))
+
+        return self._tokens
+
+    def apply(self, edits):
+        if not edits:
+            return
+
+        if self._incremental:
+            self._stale = self.source_code, self.tokens, edits
+        self._tokens = None
+
+        self.edits = _compose_edits(self.edits, edits, self.source_code)
+        self.source_code = _apply_edits(self.source_code, edits)
+
+
+def _rescan(source_code, tokens, edits, tokenize):
+    # tokens for _apply_edits(source_code, edits), reusing every old one the
+    # edits didn't touch. every token starts somewhere the tokenizer isn't in
+    # the middle of anything, so the tokens around each edit can be scanned
+    # again on their own.
+    if not tokens:
+        return list(tokenize(_apply_edits(source_code, edits)))
+
+    offsets = [token.offset for token in tokens]
+    ends = [token.offset + len(token.value) for token in tokens]
+
+    # runs of old tokens that need scanning again, with the edits in them
+    spans = []
+    for start, end, replacement in edits:
+        lo = min(bisect.bisect_left(ends, start), len(tokens) - 1)
+        hi = max(bisect.bisect_right(offsets, end), lo + 1)
+        if spans and lo < spans[-1][1]:
+            spans[-1][1] = max(hi, spans[-1][1])
+            spans[-1][2].append((start, end, replacement))
+        else:
+            spans.append([lo, hi, [(start, end, replacement)]])
+
+    new_tokens = []
+    delta = 0
+    last = 0
+
+    def add(token, offset):
+        # the tokenizer never puts two pieces of code side by side
+        if (
+            new_tokens
+            and type(token) is Code
+            and type(new_tokens[-1]) is Code
+        ):
+            previous = new_tokens.pop()
+            token = Code(previous.value + token.value, previous.offset)
+            offset = previous.offset
+        elif token.offset != offset:
+            token = type(token)(token.value, offset)
+        new_tokens.append(token)
+
+    idx = 0
+    while idx < len(spans):
+        lo, hi, span_edits = spans[idx]
+        idx += 1
+
+        for token in tokens[last:lo]:
+            add(token, token.offset + delta)
+
+        # an edit can leave a string open (or close one), so we keep going
+        # until the old token after the run comes out of the scan the same.
+        while True:
+            while idx < len(spans) and spans[idx][0] <= hi:
+                hi = max(hi, spans[idx][1])
+                span_edits.extend(spans[idx][2])
+                idx += 1
+
+            ahead = min(hi + 1, len(tokens))
+            start, end = offsets[lo], ends[ahead - 1]
+            text = _apply_edits(source_code[start:end], [
+                (edit_start - start, edit_end - start, replacement)
+                for edit_start, edit_end, replacement in span_edits
+            ])
+            scanned = list(tokenize(text))
+
+            if ahead == len(tokens) or _same_ending(scanned, tokens[hi]):
+                break
+
+            hi = min(hi + (hi - lo), len(tokens))
+
+        for token in scanned:
+            add(token, token.offset + start + delta)
+
+        delta += len(text) - (end - start)
+        last = ahead
+
+    for token in tokens[last:]:
+        add(token, token.offset + delta)
+
+    return new_tokens
+
+
+def _same_ending(scanned, token):
+    if not scanned or type(scanned[-1]) is not type(token):
+        return False
+
+    # code can run on into the code before it, but it's still code
+    if type(token) is Code:
+        return scanned[-1].value.endswith(token.value)
+
+    return scanned[-1].value == token.value
+
+
+def unified_diff(source_code, edits, filename, context=3):
+    # build the diff straight from our edits, there's no need to go looking
+    # for what changed.
+    line_starts = [0] + [
+        match.end()
+        for match in re.finditer(re.escape(os.linesep), source_code)
+    ]
+    num_lines = len(line_starts) - (line_starts[-1] == len(source_code))
+
+    def line_of(pos):
+        return bisect.bisect_right(line_starts, pos) - 1
+
+    def lines(first, last):
+        start = line_starts[first]
+        end = line_starts[last + 1] if last + 1 < len(line_starts) else len(
+            source_code
+        )
+        return source_code[start:end]
+
+    # whole lines touched by each edit, merging edits that share a line
+    blocks = []
+    for start, end, replacement in edits:
+        first = line_of(start)
+        last = line_of(end - 1) if end > start else first
+        # eating a newline joins us up with the next line
+        if end > start and source_code[end - 1] == os.linesep[-1] and (
+            not replacement.endswith(os.linesep)
+        ):
+            last = line_of(end)
+        if blocks and first <= blocks[-1][1]:
+            blocks[-1][1] = max(last, blocks[-1][1])
+            blocks[-1][2].append((start, end, replacement))
+        else:
+            blocks.append([first, last, [(start, end, replacement)]])
+
+    # blocks that are close enough share their context
+    hunks = []
+    for block in blocks:
+        if hunks and block[0] - hunks[-1][-1][1] - 1 <= 2 * context:
+            hunks[-1].append(block)
+        else:
+            hunks.append([block])
+
+    def tagged(prefix, text):
+        for line in text.splitlines(True):
+            yield prefix + line
+            if not line.endswith(os.linesep):
+                yield os.linesep + '\\ No newline at end of file' + os.linesep
+
+    if hunks:
+        yield '--- a/%s%s' % (filename, os.linesep)
+        yield '+++ b/%s%s' % (filename, os.linesep)
+
+    delta = 0
+    for hunk in hunks:
+        first = max(0, hunk[0][0] - context)
+        last = min(num_lines - 1, hunk[-1][1] + context)
+
+        body = []
+        old_count = new_count = 0
+        position = first
+
+        for block_first, block_last, block_edits in hunk:
+            if position < block_first:
+                old_lines = lines(position, block_first - 1)
+                body.extend(tagged(' ', old_lines))
+                old_count += len(old_lines.splitlines())
+                new_count += len(old_lines.splitlines())
+
+            old_lines = lines(block_first, block_last)
+            offset = line_starts[block_first]
+            new_lines = _apply_edits(old_lines, [
+                (start - offset, end - offset, replacement)
+                for start, end, replacement in block_edits
+            ])
+
+            body.extend(tagged('-', old_lines))
+            body.extend(tagged('+', new_lines))
+            old_count += len(old_lines.splitlines())
+            new_count += len(new_lines.splitlines())
+            position = block_last + 1
+
+        if position <= last:
+            old_lines = lines(position, last)
+            body.extend(tagged(' ', old_lines))
+            old_count += len(old_lines.splitlines())
+            new_count += len(old_lines.splitlines())
+
+        yield '@@ -%d,%d +%d,%d @@%s' % (
+            first + (old_count > 0),
+            old_count,
+            first + delta + (new_count > 0),
+            new_count,
+            os.linesep,
+        )
+        for line in body:
+            yield line
+
+        delta += new_count - old_count
+
+
+# top level brackets don't depend on each other, so big files can have them
+# laid out across a process pool. the workers lay each one out exactly the
+# way we would have, so the output is the same as doing it all here.
+def _layout_edits_greedy(source_code, tokenizer='native', budget=None,
+                         pool=None, cache=None, tokens=None):
+    string_edits, parenthesized, brackets, _ = _plan_layout(
+        source_code,
+        tokenizer,
+        tokens,
+    )
+
+    new_brackets = list(_layout_brackets(brackets, budget, pool, cache))
+
+    return _finish_layout(string_edits, parenthesized, brackets, new_brackets)
+
+
+# roughly how much bracket text a worker gets at a time. big enough that
+# shipping it over isn't most of the work, small enough to keep them all busy.
+PARALLEL_CHUNK_SIZE = 16384
+
+
+# lays out each of the given top level brackets in order, None for the ones
+# we ran out of budget on. workers keep their own memos, the cache is only
+# used for whatever we lay out here.
+def _layout_brackets(brackets, budget=None, pool=None, cache=None):
+    keys = [key for _, _, key in brackets]
+
+    statements = None if cache is None else cache.statements
+
+    if pool is None:
+        memo = {} if cache is None else cache
+        for key in keys:
+            new_bracket = None
+            if statements is not None:
+                new_bracket = statements.get(key)
+            if new_bracket is None:
+                new_bracket = _layout_bracket(key, memo, budget)
+                if new_bracket is None:
+                    budget.skipped += 1
+                elif statements is not None:
+                    statements.put(key, new_bracket)
+            yield new_bracket
+        return
+
+    # whatever we've laid out on an earlier run doesn't need to go anywhere
+    known = {}
+    if statements is not None:
+        for key in keys:
+            new_bracket = statements.get(key)
+            if new_bracket is not None:
+                known[key] = new_bracket
+        keys = [key for key in keys if key not in known]
+
+    chunks = [[]]
+    size = 0
+    for key in keys:
+        if size >= PARALLEL_CHUNK_SIZE:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(key)
+        size += len(key[0])
+
+    # workers get their own copy of the budget, so the clock for the file
+    # has to be running before we hand it out.
+    if budget is not None:
+        budget.start()
+
+    if len(chunks) > 1:
+        results = pool.imap(_layout_chunk, [(c, budget) for c in chunks])
+    else:
+        results = [_layout_chunk((chunks[0], budget))]
+
+    results = itertools.chain.from_iterable(results)
+
+    for key in [key for _, _, key in brackets]:
+        if key in known:
+            yield known[key]
+            continue
+
+        new_bracket = results.next()
+        if new_bracket is None:
+            budget.skipped += 1
+        elif statements is not None:
+            statements.put(key, new_bracket)
+        yield new_bracket
+
+
+def _layout_chunk(args):
+    keys, budget = args
+    memo = {}
+
+    return [_layout_bracket(key, memo, budget) for key in keys]
+
+
+def _layout_bracket(key, memo, budget=None):
+    if key in memo:
+        return memo[key]
+
+    try:
+        # starting the statement costs a step of its own, so even plain
+        # data (which _layout_data does without any) counts against it.
+        if budget is not None:
+            budget.start_statement()
+            budget.spend()
+
+        layout = rewrite_bracket(*key, budget=budget)
+    except BudgetExceeded:
+        return None
+
+    memo[key] = layout
+    return layout
+
+
+# a memo of top level bracket layouts that keeps count of how often it saved
+# us from doing a layout over again.
+class LayoutCache(dict):
+
+    def __init__(self, statements=None):
+        dict.__init__(self)
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0  # roughly, of the brackets and layouts we hold
+
+        # a StatementCache to check top level statements against first. it
+        # outlives us, so only what it counts while we're around is ours.
+        self.statements = statements
+        self._statements_before = (
+            (0, 0) if statements is None
+            else (statements.hits, statements.misses)
+        )
+
+    @property
+    def statement_hits(self):
+        if self.statements is None:
+            return 0
+        return self.statements.hits - self._statements_before[0]
+
+    @property
+    def statement_misses(self):
+        if self.statements is None:
+            return 0
+        return self.statements.misses - self._statements_before[1]
+
+    def __getitem__(self, key):
+        self.hits += 1
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        self.misses += 1
+        self.bytes += len(key[0]) + len(value or '')
+        dict.__setitem__(self, key, value)
+
+    def clear(self):
+        dict.clear(self)
+        self.bytes = 0
+
+
+def _digest(text):
+    # sha1 only takes bytes. unicode is kept apart from the same text as
+    # bytes, so whatever we cache by it comes back as the type that went in.
+    if isinstance(text, unicode):
+        text = 'u\0' + text.encode('utf-8')
+
+    return hashlib.sha1(text).digest()
+
+
+def _formatter_version():
+    # anything we change in here could change a layout, so a cache is only
+    # good for the exact code that filled it.
+    with open(os.path.splitext(__file__)[0] + '.py', 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+# roughly how many statements a StatementCache keeps between runs. the ones
+# used on the last run are kept first.
+STATEMENT_CACHE_SIZE = 200000
+
+
+# the layout of every top level statement we've done, kept on disk between
+# runs. after a small change to a big file, only the statements that changed
+# need laying out again, everything else comes straight from here.
+class StatementCache(object):
+
+    def __init__(self, path=None):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+
+        self._version = _formatter_version()
+        self._old = {}
+        self._new = {}
+
+        # marshal, not pickle: the path comes from the command line, and
+        # loading a pickle can run anything. all we keep is str -> str.
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as f:
+                try:
+                    version, self._old = marshal.load(f)
+                except Exception:  # truncated, or not ours; start over
+                    version = None
+            if version != self._version or not isinstance(self._old, dict):
+                self._old = {}
+
+    def _digest(self, key):
+        bracket_body, indent, offset = key
+        return _digest(
+            '\0'.join([str(LINE_LEN), indent, str(offset), bracket_body])
+        )
+
+    def get(self, key):
+        digest = self._digest(key)
+
+        layout = self._new.get(digest)
+        if layout is None:
+            layout = self._old.get(digest)
+            if layout is not None:
+                self._new[digest] = layout
+
+        if layout is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return layout
+
+    def put(self, key, layout):
+        self._new[self._digest(key)] = layout
+
+    def save(self, path=None):
+        path = path or self.path
+
+        statements = dict(self._new)
+        for digest, layout in self._old.iteritems():
+            if len(statements) >= STATEMENT_CACHE_SIZE:
+                break
+            statements.setdefault(digest, layout)
+
+        # written next to the old one and renamed over it, so a run that
+        # dies halfway doesn't leave the next one a broken cache.
+        fd, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)),
+        )
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                marshal.dump((self._version, statements), f)
+            os.rename(temp_path, path)
+        except Exception:
+            os.unlink(temp_path)
+            raise
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+# caps how long we'll spend laying out a file, and each top level statement
+# in it. a statement that runs over is left the way it was and we move on to
+# the next one; once the whole file is over, everything left is skipped.
+class Budget(object):
+
+    def __init__(self, seconds=None, statement_seconds=None,
+                 statement_steps=None, deadline=None):
+        self.seconds = seconds
+        self.statement_seconds = statement_seconds
+        self.statement_steps = statement_steps
+
+        # a time.time() to stop at, however late we get started
+        self.deadline = deadline
+
+        self.skipped = 0
+
+        self._deadline = None
+        self._statement_deadline = None
+        self._steps_left = None
+
+    @property
+    def partial(self):
+        return self.skipped > 0
+
+    def start(self):
+        if self._deadline is not None:
+            return
+
+        deadlines = [self.deadline]
+        if self.seconds is not None:
+            deadlines.append(time.time() + self.seconds)
+        deadlines = [d for d in deadlines if d is not None]
+
+        self._deadline = min(deadlines) if deadlines else None
+
+    def start_statement(self):
+        self.start()
+        now = time.time()
+
+        deadlines = [self._deadline]
+        if self.statement_seconds is not None:
+            deadlines.append(now + self.statement_seconds)
+        deadlines = [d for d in deadlines if d is not None]
+
+        self._statement_deadline = min(deadlines) if deadlines else None
+        self._steps_left = self.statement_steps
+
+    def spend(self):
+        if self._steps_left is not None:
+            self._steps_left -= 1
+            if self._steps_left < 0:
+                raise BudgetExceeded()
+
+        if self._statement_deadline is not None:
+            if time.time() > self._statement_deadline:
+                raise BudgetExceeded()
+
+
+def _plan_layout(source_code, tokenizer='native', tokens=None):
+    buffer = EditBuffer(source_code, tokenizer, tokens)
+
+    # long strings get parenthesized first so the bracket pass below can wrap
+    # them along with everything else.
+    string_edits = _long_string_edits(source_code, '', buffer.tokens)
+    buffer.apply(string_edits)
+    parenthesized, tokens = buffer.source_code, buffer.tokens
+
+    # every outer bracket gets laid out on its own
+    brackets = [
+        (start, stop, (
+            parenthesized[start:stop+1],
+            indent_at(parenthesized, start),
+            horizontal_location(parenthesized, start),
+        ))
+        for start, stop in find_outer_brackets(parenthesized, tokens)
+    ]
+
+    return string_edits, parenthesized, brackets, tokens
+
+
+def _finish_layout(string_edits, parenthesized, brackets, new_brackets):
+    added_parens = _added_parens(string_edits)
+    bracket_edits = []
+
+    for (start, stop, key), new_bracket in zip(brackets, new_brackets):
+        old_bracket = key[0]
+        new_bracket = _unless_skipped(new_bracket, start, key, added_parens)
+
+        if new_bracket != old_bracket:
+            bracket_edits.append((start, stop + 1, new_bracket))
+
+    return _compose_edits(string_edits, bracket_edits, parenthesized)
+
+
+# where our own parens ended up, so we can take them back out again for any
+# statement we ran out of budget on (those come back as None).
+def _added_parens(string_edits):
+    return set(
+        start + idx
+        for idx, (start, _, replacement) in enumerate(string_edits)
+        if replacement == '('
+    )
+
+
+def _unless_skipped(new_bracket, start, key, added_parens):
+    if new_bracket is not None:
+        return new_bracket
 
-    return xformer.result()
+    old_bracket = key[0]
+    if start in added_parens:
+        return old_bracket[1:-1]
 
+    return old_bracket
 
-def _wrap_long_comments(source_code):
-    xformer = SourceTransformer(source_code)
 
-    for token in parse_code(source_code):
+def _long_string_edits(source_code, indent='', tokens=None):
+    edits = []
+    depth = 0
+
+    if tokens is None:
+        tokens = parse_code(source_code)
+
+    # keep track of where the line starts as we go, big literals tend to be
+    # one very long line and looking back for it every time adds up.
+    line_start = 0
+
+    for token in tokens:
+        column = len(indent) + token.offset - line_start
+
+        # same as horizontal_location would have it
+        newline = token.value.rfind(os.linesep)
+        if newline != -1:
+            line_start = token.offset + newline + 1
+
+        if isinstance(token, Code):
+            depth += sum(char in start_chars for char in token.value)
+            depth -= sum(char in end_chars for char in token.value)
+            continue
+
+        # strings inside brackets get split by rewrite_bracket, we only need
+        # to give the ones out in the open a bracket of their own.
+        if (
+            isinstance(token, String)
+            and not token.verbatim
+            and depth == 0
+            and column < LINE_LEN - 10
+            and column + len(token.value) > LINE_LEN
+        ):
+            # split_string leaves u'' and r'' strings as they are, so a
+            # bracket of their own wouldn't get them any shorter
+            start = token.offset
+            if _prefix_start(source_code, start) != start:
+                continue
+
+            end = token.offset + len(token.value)
+
+            # base case terminates
+            if source_code[start:end] == source_code:
+                break
+
+            edits.append((start, start, '('))
+            edits.append((end, end, ')'))
+
+    return edits
+
+
+def _prefix_start(text, position):
+    # where the u'' or r'' prefix of the string at position starts
+    start = position
+    while start > 0 and text[start - 1] in 'uUbBrR':
+        start -= 1
+    if start > 0 and re.match(r'\w', text[start - 1]):
+        return position  # that was a keyword, e.g. "or'foo'"
+    return start
+
+
+def split_string(string, indent):
+    # break a string literal up so each chunk fits on its own line at indent
+    width = (LINE_LEN - 1) - len(indent)
+
+    return string[0] + (string[0] + os.linesep + indent + string[0]).join(
+        string[1:-1][i:i + width]
+        for i in xrange(0, len(string) - 2, width)
+    ) + string[-1]
+
+
+def _long_comment_edits(source_code, tokens=None):
+    edits = []
+
+    if tokens is None:
+        tokens = parse_code(source_code)
+
+    for token in tokens:
         if isinstance(token, Comment):
             horizontal_offset = horizontal_location(source_code, token.offset)
 
@@ -446,100 +1647,1080 @@ def _wrap_long_comments(source_code):
                 )
             ) + os.linesep
 
-            xformer = xformer.transform(
+            edits.append((
                 token.offset,
-                token.value,
-                wrapped_comment[horizontal_offset:]
-            )
+                token.offset + len(token.value),
+                wrapped_comment[horizontal_offset:],
+            ))
 
-    return xformer.result()
+    return edits
 
 
-def rewrite_bracket(bracket_body, indent, offset):
+def rewrite_bracket(bracket_body, indent, offset, budget=None):
+    # plain data has a quicker way of its own
+    layout = _layout_data(bracket_body, indent, offset)
+    if layout is not None:
+        return layout
+
     args = extract_args(bracket_body)
+    trees = [None if arg.startswith('#') else parse_arg(arg) for arg in args]
+    code_args = [tree for tree in trees if tree is not None]
 
     # put all of our args on one line to see if it will fit, and move comments
-    # below us
-    condensed = bracket_body[0]
-    condensed += ' '.join(
-        # cleanup newlines in our arg
-        _format_source_code(arg)
-        for arg in args
-        if not arg.startswith('#'),
-    )
-    condensed += bracket_body[-1]
-
-    multilined = bracket_body[0]
+    # below us.
+    condensed = None
+    if offset + _flat_length(code_args) < LINE_LEN:
+        condensed = bracket_body[0] + ' '.join(
+            _lay_out_tree([(tree, '')], budget) for tree in code_args
+        ) + bracket_body[-1]
+        if offset + len(condensed) >= LINE_LEN:
+            condensed = None
+    fits = condensed is not None
+
+    # if condensed fits, all we need multilined for is to see whether you've
+    # already laid things out that way, so we give up on it as soon as it
+    # stops matching what you have.
+    multilined = [bracket_body[0]]
+    matched = _match_prefix(bracket_body, 0, bracket_body[0])
 
     # edge case handling for () at the end of a line
     if args:
-        multilined += os.linesep
+        multilined.append(os.linesep)
+        matched = _match_prefix(bracket_body, matched, os.linesep)
+
+    for arg, tree in zip(args, trees):
+        if fits and matched < 0:
+            break
+
+        # comments don't get mutated, and if this arg is a string, and it
+        # appears at least slightly before the end of the page, and it falls
+        # off the page, we split it into chunks. there's nothing else in
+        # there to format.
+        if tree is None:
+            piece = arg
+        elif (
+            offset < LINE_LEN - 10
+            and offset + len(arg) > LINE_LEN
+            and tree.only_string
+        ):
+            piece = split_string(arg, indent + '    ')
+        else:
+            piece = _lay_out_tree([(tree, indent + '    ')], budget)
+
+        for text in [indent + '    ', piece, os.linesep]:
+            matched = _match_prefix(bracket_body, matched, text)
+            multilined.append(text)
+    else:
+        # edge case handling for () at the end of a line
+        if args:
+            multilined.append(indent)
+            matched = _match_prefix(bracket_body, matched, indent)
+
+        multilined.append(bracket_body[-1])
+        matched = _match_prefix(bracket_body, matched, bracket_body[-1])
 
-    for arg in args:
-        multilined += indent + '    '
+    # if you multi-lined your args and they look good, we won't touch them,
+    # even if they can fit within 80 characters.
+    if fits and matched != len(bracket_body):
+        comments = [arg for arg in args if arg.startswith('#')]
+        if comments:
+            condensed += os.linesep + indent
+        return condensed + (os.linesep + indent).join(comments)
+
+    return ''.join(multilined)
+
+
+# below the top, every bracket is read into a tree once, by parse_arg, and
+# laid out from there. a bracket's args go on one line if they fit, and one
+# per line (a waterfall) if they don't. laying a bracket out never makes it
+# any shorter than it is with everything flat on one line, so that length
+# (worked out bottom up as the tree is read) tells us straight away when
+# there's no point trying the one line, and the only brackets we ever try it
+# for are short ones. deep nesting is laid out off an explicit stack.
+
+
+class Bracket(object):
+
+    def __init__(self, open_char, start=0):
+        self.open_char = open_char
+        self.close_char = None
+        self.start = start  # where we open, in the arg we were read from
+        self.args = []
+
+        # how long we are, as we appear in our parent's arg and with all of
+        # us flat on one line
+        self.length = 0
+        self.flat_length = 0
+
+        # after the last line break in us (in a string, there's nowhere else
+        # for one): how many chars there are, and the indent of that line
+        self.tail = None
+        self.tail_indent = 0
+
+
+class ArgString(object):
+
+    def __init__(self, value):
+        self.prefix = ''  # u, r, b and the like, if they go with us
+        self.value = value
+
+        self.tail = None
+        self.tail_indent = 0
+
+        newline = value.rfind(os.linesep)
+        if newline != -1:
+            line = value[newline + len(os.linesep):]
+            self.tail = len(line)
+            self.tail_indent = len(line) - len(line.lstrip())
+
+    @property
+    def length(self):
+        return len(self.prefix) + len(self.value)
+
+    flat_length = length
+
+    @property
+    def verbatim(self):
+        return self.value[:3] in ('"""', "'''")
+
+
+class Arg(object):
+    # one arg of a bracket. parts are the text, strings and brackets in it,
+    # which add up to what extract_args would have given us for it.
+
+    def __init__(self, parts):
+        self.parts = parts
+        self.length = 0
+        self.flat_length = 0
 
-        # well this is obvious...
-        #
-        # if this arg is a string, and it appears at least slightly before the
-        # end of the page, and it falls off the page, then:
-        arg_source = list(parse_code(arg))
+        for part in parts:
+            if isinstance(part, basestring):
+                self.length += len(part)
+                self.flat_length += len(part)
+            else:
+                self.length += part.length
+                self.flat_length += part.flat_length
+
+        self.only_string = (
+            len(parts) == 1
+            and isinstance(parts[0], ArgString)
+            and not parts[0].prefix
+            and not parts[0].verbatim
+        )
+
+
+def _flat_length(args):
+    return 2 + sum(arg.flat_length for arg in args) + max(len(args) - 1, 0)
+
+
+def parse_arg(arg):
+    # reads an arg (as it comes out of extract_args, so squashed up and with
+    # no comments) into a tree, splitting up every bracket in it the same way
+    # extract_args would have.
+    tokens = list(parse_code(arg))
+    comprehensions = _find_comprehensions(tokens)
+
+    # [bracket, whether it's a comprehension, parts of the arg we're in]
+    stack = [[None, False, []]]
+    last_line = 0
+    last_line_indent = 0
+
+    for token in tokens:
+        if isinstance(token, String):
+            stack[-1][2].append(ArgString(token.value))
+            if stack[-1][2][-1].tail is not None:
+                last_line = token.offset + len(token.value) - (
+                    stack[-1][2][-1].tail
+                )
+                last_line_indent = stack[-1][2][-1].tail_indent
+            continue
+
+        subtokens = token.subtokens
+        for idx, sub in enumerate(subtokens):
+            bracket, in_comprehension, parts = stack[-1]
+
+            if sub.value in start_chars:
+                stack.append([
+                    Bracket(sub.value, sub.offset),
+                    sub.offset in comprehensions,
+                    [],
+                ])
+                continue
+
+            if sub.value in end_chars and bracket is not None:
+                stack.pop()
+                if _has_text(parts):
+                    bracket.args.append(_make_arg(parts))
+
+                bracket.close_char = sub.value
+                bracket.length = sub.offset + 1 - bracket.start
+                bracket.flat_length = _flat_length(bracket.args)
+                if last_line > bracket.start:
+                    bracket.tail = sub.offset + 1 - last_line
+                    bracket.tail_indent = last_line_indent
+
+                stack[-1][2].append(bracket)
+                continue
+
+            if bracket is None:
+                parts.append(sub.value)
+                continue
+
+            # the rest is extract_args over again
+            following = subtokens[idx + 1:idx + 3]
+            splits_before = (
+                isinstance(sub, Whitespace)
+                and len(following) == 2
+                and isinstance(following[0], Keyword)
+                and isinstance(following[1], Whitespace)
+            )
+
+            if not splits_before and sub.value != ',':
+                parts.append(sub.value)
+
+            elif not in_comprehension and sub.value == ',':
+                if _has_text(parts):
+                    bracket.args.append(_make_arg(parts, ','))
+                    stack[-1][2] = []
+
+            elif not in_comprehension and following[0].value in (
+                'and',
+                'or',
+                'else',
+                'if',
+            ):
+                if _has_text(parts):
+                    bracket.args.append(_make_arg(parts))
+                    stack[-1][2] = []
+
+            elif (
+                in_comprehension
+                and splits_before
+                and following[0].value in ('for', 'if')
+                and sub.value[-1] == ' '
+                and following[1].value[0] == ' '
+            ):
+                parts.append(sub.value[:-1])
+                bracket.args.append(_make_arg(parts))
+                stack[-1][2] = []
+
+            else:
+                parts.append(sub.value)
+
+    return _make_arg(stack[0][2])
+
+
+def _has_text(parts):
+    return any(
+        not isinstance(part, basestring) or part.strip() for part in parts
+    )
+
+
+def _make_arg(parts, end=''):
+    # the same as current_line.strip() + end in extract_args
+    merged = []
+    for part in parts:
         if (
-            len(arg_source) == 1
-            and isinstance(arg_source[0], String)
-            and not arg_source[0].verbatim
-            and offset < LINE_LEN - 10
-            and offset + len(arg) > LINE_LEN
+            isinstance(part, basestring)
+            and merged
+            and isinstance(merged[-1], basestring)
         ):
-            # split the string into chunks
-            arg = (
-                arg[0] + (arg[0] + os.linesep + indent + '    ' + arg[0]).join(
-                    arg[1:-1][i:i + (LINE_LEN - 1) - len(indent) - 4]
-                    for i in xrange(
-                        0,
-                        len(arg) - 2,
-                        (LINE_LEN - 1) - len(indent) - 4
-                    )
-                ) + arg[
-                    -1
-                ]
+            merged[-1] += part
+        else:
+            merged.append(part)
+
+    if merged and isinstance(merged[0], basestring):
+        merged[0] = merged[0].lstrip()
+    if merged and isinstance(merged[-1], basestring):
+        merged[-1] = merged[-1].rstrip()
+    if end:
+        merged.append(end)
+
+    # u'' and r'' prefixes go with their string, like _long_string_edits
+    # has them
+    parts = []
+    for part in merged:
+        if isinstance(part, ArgString) and parts and isinstance(
+            parts[-1],
+            basestring,
+        ):
+            code = parts.pop()
+            prefix = len(code) - len(code.rstrip('uUbBrR'))
+            if prefix and not (
+                len(code) > prefix and re.match(r'\w', code[-prefix - 1])
+            ):
+                part.prefix = code[-prefix:]
+                code = code[:-prefix]
+            if code:
+                parts.append(code)
+
+        if part != '':
+            parts.append(part)
+
+    return Arg(parts)
+
+
+def _find_comprehensions(tokens):
+    # where the brackets that extract_args would take for comprehensions
+    # open: there's a " for " in one of their runs of code that starts out in
+    # the open, i.e. right after the bracket opens or after a string of its
+    # own. (the run can go on into other brackets, and it still counts.)
+    fors = []
+    comprehensions = set()
+
+    # [where the bracket opened, where its current run of code started]
+    stack = []
+    after_string = None
+
+    def check(entry, end):
+        if entry[1] is None:
+            return
+        idx = bisect.bisect_left(fors, entry[1])
+        if idx < len(fors) and fors[idx] + len(' for ') <= end:
+            comprehensions.add(entry[0])
+        entry[1] = None
+
+    for token in tokens:
+        if isinstance(token, String):
+            after_string = stack[-1] if stack else None
+            continue
+
+        found = token.value.find(' for ')
+        while found != -1:
+            fors.append(token.offset + found)
+            found = token.value.find(' for ', found + 1)
+
+        running = []
+        if after_string is not None:
+            after_string[1] = token.offset
+            running.append(after_string)
+            after_string = None
+
+        for sub in token.subtokens:
+            if sub.value in start_chars:
+                stack.append([sub.offset, sub.offset + 1])
+                running.append(stack[-1])
+            elif sub.value in end_chars and stack:
+                check(stack.pop(), sub.offset)
+
+        end = token.offset + len(token.value)
+        for entry in running:
+            check(entry, end)
+
+    return comprehensions
+
+
+def _lay_out_tree(tasks, budget=None):
+    # tasks get done last one first: text goes straight out, (arg, indent)
+    # gets formatted and (bracket, indent, offset) gets laid out, each by
+    # putting more tasks on.
+    out = []
+
+    while tasks:
+        task = tasks.pop()
+
+        if isinstance(task, basestring):
+            out.append(task)
+        elif len(task) == 2:
+            tasks.extend(reversed(_arg_tasks(*task)))
+        else:
+            if budget is not None:
+                budget.spend()
+
+            condensed = _condensed(*task + (budget,))
+            if condensed is not None:
+                out.append(condensed)
+            else:
+                tasks.extend(reversed(_multilined_tasks(*task)))
+
+    return ''.join(out)
+
+
+def _condensed(bracket, indent, offset, budget=None):
+    if offset + bracket.flat_length >= LINE_LEN:
+        return None
+
+    condensed = bracket.open_char + ' '.join(
+        _lay_out_tree([(arg, '')], budget) for arg in bracket.args
+    ) + bracket.close_char
+
+    if offset + len(condensed) >= LINE_LEN:
+        return None
+
+    return condensed
+
+
+def _multilined_tasks(bracket, indent, offset):
+    arg_indent = indent + '    '
+    tasks = [bracket.open_char]
+
+    if bracket.args:
+        tasks.append(os.linesep)
+
+    for arg in bracket.args:
+        tasks.append(arg_indent)
+        if (
+            offset < LINE_LEN - 10
+            and offset + arg.length > LINE_LEN
+            and arg.only_string
+        ):
+            tasks.append(split_string(arg.parts[0].value, arg_indent))
+        else:
+            tasks.append((arg, arg_indent))
+        tasks.append(os.linesep)
+
+    if bracket.args:
+        tasks.append(indent)
+    tasks.append(bracket.close_char)
+
+    return tasks
+
+
+def _arg_tasks(arg, indent):
+    # an arg is laid out where it is, same as a statement would be: long
+    # strings out in the open get a bracket of their own (see
+    # _long_string_edits), then every bracket gets laid out at wherever it
+    # ends up once they have.
+    tasks = []
+
+    position = 0
+    line_start = 0
+    # with the long strings in brackets
+    bracketed_position = 0
+    bracketed_line_start = 0
+    line_indent = ''
+
+    for part in arg.parts:
+        if isinstance(part, basestring):
+            tasks.append(part)
+            position += len(part)
+            bracketed_position += len(part)
+            continue
+
+        added = 0
+        layout = part
+
+        if isinstance(part, ArgString):
+            column = len(indent) + position + len(part.prefix) - line_start
+            if (
+                not part.verbatim
+                and not part.prefix
+                and column < LINE_LEN - 10
+                and column + len(part.value) > LINE_LEN
+                and part.length != arg.length
+            ):
+                layout = _string_bracket(part)
+                added = 1
+
+        if layout is part and isinstance(part, ArgString):
+            tasks.append(part.prefix + part.value)
+        else:
+            tasks.append((
+                layout,
+                indent + line_indent,
+                len(indent) + bracketed_position - bracketed_line_start,
+            ))
+
+        if part.tail is not None:
+            line_start = position + part.length - part.tail
+            bracketed_line_start = (
+                bracketed_position + added + part.length - part.tail
             )
+            line_indent = part.tail_indent * ' '
 
-        multilined += _format_source_code(arg, indent + '    ')
+        position += part.length
+        bracketed_position += part.length + 2 * added
 
-        line_end = ''
+    return tasks
 
-        # "**kwargs," is a syntax error, as is "*args," if not followed by
-        # kwargs.
-        if arg.startswith('*') and arg == args[-1]:
-            line_end = ''
 
-        # comments don't get mutated, and
-        if arg.startswith('#'):
-            line_end = ''
+def _string_bracket(string):
+    bracket = Bracket('(')
+    bracket.close_char = ')'
+    bracket.args.append(Arg([string]))
+    bracket.length = string.length + 2
+    bracket.flat_length = _flat_length(bracket.args)
+    bracket.tail = string.tail
+    if string.tail is not None:
+        bracket.tail += 1
+    bracket.tail_indent = string.tail_indent
 
-        # "(foo)" can't be expanded to "(foo,)" because that now makes it a
-        # tuple which has different logical implications.
-        if len(args) == 1:
-            line_end = ''
+    return bracket
 
-        multilined += line_end
-        multilined += os.linesep
 
-    # edge case handling for () at the end of a line
-    if args:
-        multilined += indent
+def _match_prefix(text, pos, piece):
+    # how far into text we've matched once piece is on the end, or -1 if
+    # we've stopped matching
+    if pos < 0 or not text.startswith(piece, pos):
+        return -1
+    return pos + len(piece)
 
-    multilined += bracket_body[-1]
 
-    # if you multi-lined your args and they look good, we won't touch them,
-    # even if they can fit within 80 characters.
-    if offset + len(condensed) < LINE_LEN and bracket_body != multilined:
-        if any(a.startswith('#') for a in args):
-            condensed += os.linesep + indent
-        return condensed + (os.linesep + indent).join(
-            a
-            for a in args
-            if a.startswith('#'),
+# big literals of plain data (numbers, strings, True/False/None and brackets
+# of those, like fixtures and config) are most of what gets formatted in some
+# files, so they get a quicker tree of their own: we read the whole literal
+# with a single scan, and work out what rewrite_bracket would have given us
+# straight from that. anything we're not sure it would agree on (comments,
+# long strings, keywords, names, ...) goes back to the usual way.
+DATA_MAX_DEPTH = 100
+
+data_word_matcher = re.compile(r'\d\w*$|(True|False|None)$')
+string_prefix_matcher = re.compile(r'[uUbB]?[rR]?$')
+
+
+class NotPlainData(Exception):
+    pass
+
+
+class DataBracket(object):
+    # one bracket of a data literal. its args are lists of text and the
+    # brackets nested in them, with whitespace squashed the way extract_args
+    # does it. positions and lengths are measured in that squashed text.
+
+    def __init__(self, open_char, position):
+        self.open_char = open_char
+        self.close_char = None
+        self.position = position  # where we start in our parent's arg
+        self.length = 1  # as we appear, squashed, in our parent's arg
+        self.args = []
+
+        # how long we are with everything on one line, and whether laying us
+        # out that way is as simple as it looks
+        self.flat_length = None
+        self.flat_ok = True
+
+        self._start_arg()
+
+    def _start_arg(self):
+        self.parts = []
+        self.strings = []  # (position, length) of our strings
+        self.arg_length = 0
+        self.arg_flat_length = 0
+        self.text_only = True
+        self.pending_space = False
+        self.after_string = False
+
+    def _flush(self):
+        if self.pending_space:
+            self.parts.append(' ')
+            self.arg_length += 1
+            self.arg_flat_length += 1
+            self.pending_space = False
+
+    def add_space(self):
+        self.length += 1
+        if self.arg_length:
+            self.pending_space = True
+
+    def add_text(self, text):
+        self._flush()
+        self.parts.append(text)
+        self.arg_length += len(text)
+        self.arg_flat_length += len(text)
+        self.length += len(text)
+        self.after_string = False
+
+    def add_string(self, string):
+        # "'a' 'b'" gets joined up by extract_args
+        if self.after_string:
+            raise NotPlainData()
+
+        self._flush()
+        self.strings.append((self.arg_length, len(string)))
+        self.add_text(string)
+        self.after_string = True
+
+    def open_bracket(self, open_char):
+        self._flush()
+        return DataBracket(open_char, self.arg_length)
+
+    def add_bracket(self, bracket):
+        self.parts.append(bracket)
+        self.arg_length += bracket.length
+        self.arg_flat_length += bracket.flat_length
+        self.length += bracket.length
+        self.text_only = False
+        self.after_string = False
+
+        # flat inside a flat parent only if it would have fit on its own
+        self.flat_ok = self.flat_ok and bracket.flat_ok and (
+            bracket.position + bracket.flat_length < LINE_LEN
         )
 
-    return multilined
+    def end_arg(self, comma):
+        if comma:
+            self.length += 1
+
+        # an empty arg loses its comma, same as in extract_args
+        if self.arg_length:
+            if comma:
+                self.parts.append(',')
+                self.arg_length += 1
+                self.arg_flat_length += 1
+
+            arg = DataArg(
+                self.parts,
+                self.arg_length,
+                self.arg_flat_length,
+                self.strings,
+                ''.join(self.parts) if self.text_only else None,
+            )
+            self.args.append(arg)
+
+            # we're laid out flat with no indent, that's where our strings are
+            if not arg.strings_fit(0):
+                self.flat_ok = False
+
+        self._start_arg()
+
+    def close(self, close_char):
+        self.end_arg(False)
+        self.close_char = close_char
+        self.length += 1
+        self.flat_length = 2 + sum(
+            arg.flat_length for arg in self.args
+        ) + max(len(self.args) - 1, 0)
+
+
+class DataArg(object):
+
+    def __init__(self, parts, length, flat_length, strings, text):
+        self.parts = parts
+        self.length = length
+        self.flat_length = flat_length
+        self.strings = strings
+        self.text = text  # only when there's no brackets in it
+
+    @property
+    def only_string(self):
+        return self.text is not None and self.strings == [(0, self.length)]
+
+    def strings_fit(self, column):
+        # whether _long_string_edits leaves our strings alone at column
+        for position, length in self.strings:
+            if not (
+                column + position < LINE_LEN - 10
+                and column + position + length > LINE_LEN
+            ):
+                continue
+
+            if self.text is None:
+                return False
+
+            # it doesn't bother with a prefixed string, or one that's the
+            # whole thing
+            start = _prefix_start(self.text, position)
+            if start != position:
+                continue
+            return self.text[start:position + length] == self.text
+
+        return True
+
+
+def parse_data(bracket_body):
+    # the tree of brackets for a data literal, or None if it isn't one
+    tokens = list(parse_code(bracket_body))
+    stack = []
+    root = None
+
+    try:
+        for idx, token in enumerate(tokens):
+            if isinstance(token, Comment) or root is not None:
+                return None
+
+            if isinstance(token, String):
+                if token.verbatim or '\n' in token.value or not stack:
+                    return None
+                stack[-1].add_string(token.value)
+                continue
+
+            for match in code_scanner.finditer(token.value):
+                whitespace, word, char = match.groups()
+
+                if root is not None:
+                    return None
+
+                if whitespace:
+                    if stack:
+                        stack[-1].add_space()
+                    continue
+
+                if not stack and char not in start_chars:
+                    return None
+
+                if word:
+                    prefixes_string = (
+                        string_prefix_matcher.match(word)
+                        and match.end() == len(token.value)
+                        and idx + 1 < len(tokens)
+                    )
+                    if not data_word_matcher.match(word) and not (
+                        prefixes_string
+                    ):
+                        return None
+                    stack[-1].add_text(word)
+                elif char in start_chars:
+                    if len(stack) >= DATA_MAX_DEPTH:
+                        return None
+                    if stack:
+                        stack.append(stack[-1].open_bracket(char))
+                    else:
+                        stack.append(DataBracket(char, 0))
+                elif char in end_chars:
+                    bracket = stack.pop()
+                    bracket.close(char)
+                    if stack:
+                        stack[-1].add_bracket(bracket)
+                    else:
+                        root = bracket
+                elif char == ',':
+                    stack[-1].end_arg(True)
+                elif char in ':.+-':
+                    stack[-1].add_text(char)
+                else:
+                    return None
+    except NotPlainData:
+        return None
+
+    return root
+
+
+def _layout_data(bracket_body, indent, offset):
+    root = parse_data(bracket_body)
+    if root is None:
+        return None
+
+    try:
+        multilined = []
+        _multiline_data(root, indent, offset, multilined)
+        multilined = ''.join(multilined)
+
+        if offset + root.flat_length >= LINE_LEN:
+            return multilined
+
+        if not root.flat_ok:
+            return None
+
+        # already laid out like we would have, so it stays that way
+        if multilined == bracket_body:
+            return multilined
+
+        condensed = []
+        _flatten_data(root, condensed)
+        return ''.join(condensed)
+    except NotPlainData:
+        return None
+
+
+def _lay_out_data(bracket, indent, offset, out):
+    if offset + bracket.flat_length < LINE_LEN:
+        if not bracket.flat_ok:
+            raise NotPlainData()
+        _flatten_data(bracket, out)
+    else:
+        _multiline_data(bracket, indent, offset, out)
+
+
+def _flatten_data(bracket, out):
+    out.append(bracket.open_char)
+
+    for idx, arg in enumerate(bracket.args):
+        if idx:
+            out.append(' ')
+        for part in arg.parts:
+            if isinstance(part, DataBracket):
+                _flatten_data(part, out)
+            else:
+                out.append(part)
+
+    out.append(bracket.close_char)
+
+
+def _multiline_data(bracket, indent, offset, out):
+    arg_indent = indent + '    '
+
+    out.append(bracket.open_char)
+    if bracket.args:
+        out.append(os.linesep)
+
+    for arg in bracket.args:
+        out.append(arg_indent)
+
+        if (
+            offset < LINE_LEN - 10
+            and offset + arg.length > LINE_LEN
+            and arg.only_string
+        ):
+            out.append(split_string(arg.text, arg_indent))
+        elif not arg.strings_fit(len(arg_indent)):
+            raise NotPlainData()
+        else:
+            for part in arg.parts:
+                if isinstance(part, DataBracket):
+                    _lay_out_data(
+                        part,
+                        arg_indent,
+                        len(arg_indent) + part.position,
+                        out,
+                    )
+                else:
+                    out.append(part)
+
+        out.append(os.linesep)
+
+    if bracket.args:
+        out.append(indent)
+    out.append(bracket.close_char)
+
+
+# the "optimal" layout treats every bracket as a group which is either printed
+# flat, or broken with one arg per line. brackets are flattened into a stream
+# of ops, measured right to left, and printed left to right in one go (a la
+# Oppen), so we never re-scan text and the output is stable after one pass.
+_TEXT, _NEWLINE, _LINE, _BEGIN, _END = range(5)
+
+
+class Group(object):
+
+    def __init__(self, open_char, close_char):
+        self.open_char = open_char
+        self.close_char = close_char
+        self.args = []
+        self.forced = False
+
+
+def build_doc(source_code, tokens=None, spans=None, budget=None):
+    # each top level bracket counts as a statement against the budget. one
+    # that runs out is left as plain text, just the way it was.
+    doc = []
+    last = 0
+
+    for start, stop in find_outer_brackets(source_code, tokens):
+        doc.append(source_code[last:start])
+        bracket = source_code[start:stop + 1]
+
+        try:
+            if budget is not None:
+                budget.start_statement()
+            doc.append(_build_group(bracket, budget))
+        except BudgetExceeded:
+            budget.skipped += 1
+            doc.append(bracket)
+        else:
+            if spans is not None:
+                spans.append((start, stop + 1))
+
+        last = stop + 1
+
+    doc.append(source_code[last:])
+
+    return doc
+
+
+def _build_group(bracket, budget=None):
+    pending = []
+    group = _new_group(bracket, pending)
+
+    # every level of nesting scans its args all over again, so deep brackets
+    # are where the time goes.
+    while pending:
+        if budget is not None:
+            budget.spend()
+
+        text, out = pending.pop()
+        last = 0
+
+        for start, stop in find_outer_brackets(text):
+            out.append(text[last:start])
+            out.append(_new_group(text[start:stop + 1], pending))
+            last = stop + 1
+
+        out.append(text[last:])
+
+    return group
+
+
+def _new_group(bracket, pending):
+    # neighbouring comments get joined, like destroy_backslashes would do on
+    # the next run.
+    args = []
+    for arg in extract_args(bracket):
+        if arg[:2] == '# ' and args and args[-1][:2] == '# ':
+            args[-1] += arg[1:]
+        else:
+            args.append(arg)
+
+    group = Group(bracket[0], bracket[-1])
+    for arg in args:
+        # comments need a line to themselves
+        group.forced = group.forced or arg.startswith('#')
+
+        arg_doc = []
+        group.args.append(arg_doc)
+        pending.append((arg, arg_doc))
+
+    return group
+
+
+def _group_ops(group):
+    ops = [(_BEGIN, group.forced), (_TEXT, group.open_char)]
+
+    for idx, arg_doc in enumerate(group.args):
+        ops.append((_LINE, ' ' if idx else '', 4))
+        ops.append(arg_doc)
+
+    if group.args:
+        ops.append((_LINE, '', 0))
+
+    ops.append((_TEXT, group.close_char))
+    ops.append((_END,))
+
+    return ops
+
+
+def flatten_doc(doc):
+    ops = []
+    stack = [iter(doc)]
+
+    while stack:
+        for item in stack[-1]:
+            if isinstance(item, Group):
+                stack.append(iter(_group_ops(item)))
+                break
+            elif isinstance(item, list):
+                stack.append(iter(item))
+                break
+            elif isinstance(item, tuple):
+                ops.append(item)
+            else:
+                for idx, line in enumerate(item.split(os.linesep)):
+                    if idx:
+                        ops.append((_NEWLINE,))
+                    if line:
+                        ops.append((_TEXT, line))
+        else:
+            stack.pop()
+
+    return ops
+
+
+def print_ops(ops, width=None, spans=None):
+    width = width or LINE_LEN
+
+    # widths[i] is the flat width of everything before op i, and hard[i]
+    # counts the things before op i that can never be flat.
+    widths = [0]
+    hard = [0]
+    for op in ops:
+        widths.append(widths[-1] + (
+            len(op[1]) if op[0] in (_TEXT, _LINE) else 0
+        ))
+        hard.append(hard[-1] + (
+            op[0] == _NEWLINE or (op[0] == _BEGIN and op[1])
+        ))
+
+    # match up groups, and find how much text trails each one before the next
+    # chance we get to break the line.
+    ends = {}
+    trailing = {}
+    opened = []
+    run = 0
+    for idx in xrange(len(ops) - 1, -1, -1):
+        kind = ops[idx][0]
+        if kind in (_LINE, _NEWLINE):
+            run = 0
+        elif kind == _TEXT:
+            run += len(ops[idx][1])
+        elif kind == _END:
+            opened.append(idx)
+            trailing[idx] = run
+        elif kind == _BEGIN:
+            ends[idx] = opened.pop()
+
+    result = []
+    length = 0
+    column = 0
+    line_indent = 0
+    leading = True
+    groups = []
+
+    for idx, op in enumerate(ops):
+        kind = op[0]
+
+        if kind == _TEXT:
+            if leading:
+                stripped = op[1].lstrip(' ')
+                line_indent += len(op[1]) - len(stripped)
+                leading = not stripped
+            result.append(op[1])
+            length += len(op[1])
+            column += len(op[1])
+
+        elif kind == _NEWLINE:
+            result.append(os.linesep)
+            length += len(os.linesep)
+            column = 0
+            line_indent = 0
+            leading = True
+
+        elif kind == _BEGIN:
+            end = ends[idx]
+            flat = (groups and groups[-1][1]) or (
+                hard[end] == hard[idx]
+                and column + widths[end] - widths[idx] + trailing[end] <= width
+            )
+            if spans is not None and not groups:
+                spans.append(length)
+            groups.append((line_indent, flat))
+
+        elif kind == _LINE:
+            base, flat = groups[-1]
+            if flat:
+                result.append(op[1])
+                length += len(op[1])
+                column += len(op[1])
+            else:
+                line_indent = column = base + op[2]
+                leading = False
+                result.append(os.linesep + column * ' ')
+                length += len(result[-1])
+
+        elif kind == _END:
+            groups.pop()
+            if spans is not None and not groups:
+                spans.append(length)
+
+    return ''.join(result)
+
+
+def _layout_edits_optimal(source_code, tokenizer='native', budget=None,
+                          pool=None, cache=None, tokens=None):
+    # the whole file gets printed in one go, so there's nothing to farm out
+    # to a pool or cache. the budget is spent in build_doc, where nesting
+    # makes the work quadratic.
+    if tokens is None:
+        tokens = list(TOKENIZERS[tokenizer](source_code))
+
+    # text outside of brackets comes out untouched, so lining up where each
+    # top level bracket went in and came out gives us our edits. brackets
+    # that ran out of budget are just text too.
+    old_spans = []
+    new_spans = []
+    result = print_ops(
+        flatten_doc(build_doc(source_code, tokens, old_spans, budget)),
+        spans=new_spans,
+    )
+
+    edits = []
+    for idx, (start, end) in enumerate(old_spans):
+        replacement = result[new_spans[2 * idx]:new_spans[2 * idx + 1]]
+        if replacement != source_code[start:end]:
+            edits.append((start, end, replacement))
+
+    return edits
+
+
+LAYOUTS = {
+    'greedy': _layout_edits_greedy,
+    'optimal': _layout_edits_optimal,
+}
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import resource
+import sys
+import time
+
+
+def peak_rss_kb():
+    # linux counts in kilobytes, os x in bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+class RunReport(object):
+
+    def __init__(self):
+        self.files = []
+        self.started = time.time()
+        self.seconds = 0.0
+        self.shard = None
+
+    def add(self, path, status, seconds, stats):
+        # python 2 doesn't have tracemalloc, so the best we can do per file
+        # is where the process' high water mark was once we were done.
+        record = dict(stats)
+        record.update(
+            path=path,
+            status=status,
+            seconds=seconds,
+            peak_rss_kb=peak_rss_kb(),
+        )
+        self.files.append(record)
+
+        self.seconds = time.time() - self.started
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+
+        run = cls()
+        run.files = data['per_file']
+        run.seconds = data['seconds']
+        run.shard = data.get('shard')
+
+        return run
+
+    @classmethod
+    def merge(cls, runs):
+        # shards run side by side, so the merged run took as long as the
+        # slowest of them. everything else is added back up from per_file.
+        merged = cls()
+        for run in runs:
+            merged.files.extend(run.files)
+        merged.files.sort(key=lambda record: record['path'])
+        merged.seconds = max([run.seconds for run in runs] or [0.0])
+
+        return merged
+
+    def count(self, status):
+        return sum(1 for record in self.files if record['status'] == status)
+
+    def cache_counts(self, name):
+        hits = sum(record.get(name + '_hits', 0) for record in self.files)
+        misses = sum(record.get(name + '_misses', 0) for record in self.files)
+
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': (
+                float(hits) / (hits + misses) if hits + misses else 0.0
+            ),
+        }
+
+    def to_dict(self, slowest=10):
+        bytes_in = sum(record.get('bytes_in', 0) for record in self.files)
+        bytes_out = sum(record.get('bytes_out', 0) for record in self.files)
+
+        result = {
+            'files': {
+                'seen': len(self.files),
+                'changed': self.count('changed'),
+                'unchanged': self.count('unchanged'),
+                'skipped': self.count('skipped'),
+                'failed': self.count('failed'),
+                'partial': sum(
+                    1 for record in self.files
+                    if record.get('statements_skipped')
+                ),
+            },
+            'bytes_in': bytes_in,
+            'bytes_out': bytes_out,
+            'seconds': self.seconds,
+            'bytes_per_second': bytes_in / self.seconds if self.seconds else 0,
+            'files_per_second': (
+                len(self.files) / self.seconds if self.seconds else 0
+            ),
+            'peak_rss_kb': max(
+                [record['peak_rss_kb'] for record in self.files] or [0]
+            ),
+            'cache': self.cache_counts('cache'),
+            # the --cache file, kept between runs
+            'statement_cache': self.cache_counts('statement_cache'),
+            'slowest': [
+                {'path': record['path'], 'seconds': record['seconds']}
+                for record in sorted(
+                    self.files,
+                    key=lambda record: record['seconds'],
+                    reverse=True,
+                )[:slowest]
+            ],
+            'per_file': self.files,
+        }
+
+        if self.shard is not None:
+            result['shard'] = self.shard
+
+        return result
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(
+                self.to_dict(),
+                f,
+                indent=2,
+                separators=(',', ': '),
+                sort_keys=True,
+            )
+            f.write('\n')
+
+
+def parse_args(args=None):
+    args = args or sys.argv[1:]
+
+    parser = argparse.ArgumentParser(
+        description="Merge the reports of a --shard'ed run into one.",
+    )
+
+    parser.add_argument(
+        '-o', '--output',
+        required=True,
+        help="Where to write the merged report.",
+    )
+
+    parser.add_argument(
+        'report',
+        nargs='+',
+        help="Reports written by each shard's --report.",
+    )
+
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+
+    runs = [RunReport.load(path) for path in args.report]
+
+    counts = set(run.shard[1] for run in runs if run.shard)
+    if len(counts) > 1:
+        sys.exit('reports come from different numbers of shards')
+
+    RunReport.merge(runs).write(args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,9 +2,18 @@
 # -*- coding: utf-8 -*-
 import argparse
 import ast
+import io
+import itertools
+import multiprocessing
+import os
+import shutil
+import subprocess
 import sys
+import tempfile
+import time
 
 import indently.lib
+import indently.report
 
 
 def parse_args(args=None):
@@ -24,12 +33,111 @@ def parse_args(args=None):
         help="Rewrite input files. Incompatible with stdin.",
     )
 
+    parser.add_argument(
+        '--diff',
+        action='store_true',
+        help="Print a unified diff of the changes instead of the new source.",
+    )
+
     parser.add_argument(
         '--no-validate',
         action='store_true',
         help="Do not confirm input or output to be valid Python.",
     )
 
+    parser.add_argument(
+        '--layout',
+        choices=sorted(indently.lib.LAYOUTS),
+        default='greedy',
+        help="How to lay out brackets. 'optimal' needs only one pass.",
+    )
+
+    parser.add_argument(
+        '--tokenizer',
+        choices=sorted(indently.lib.TOKENIZERS),
+        default='native',
+        help="Which tokenizer to read source with.",
+    )
+
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        metavar='SECONDS',
+        help="Most time to spend on one file. Statements left over when "
+             "it runs out are not reformatted.",
+    )
+
+    parser.add_argument(
+        '--statement-timeout',
+        type=float,
+        metavar='SECONDS',
+        help="Most time to spend on one statement before leaving it alone.",
+    )
+
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help="Lay out the statements of each file across this many processes.",
+    )
+
+    parser.add_argument(
+        '--max-size',
+        type=int,
+        metavar='BYTES',
+        help="Leave files bigger than this alone.",
+    )
+
+    parser.add_argument(
+        '--include-generated',
+        action='store_true',
+        help="Format generated files too, instead of leaving them alone.",
+    )
+
+    parser.add_argument(
+        '--report',
+        metavar='PATH',
+        help="Write a JSON summary of the run to PATH. Files that fail to "
+             "format are recorded there instead of stopping the run.",
+    )
+
+    parser.add_argument(
+        '--cache',
+        metavar='PATH',
+        help="Keep the layout of every statement in PATH between runs, so "
+             "only statements that changed since are laid out again.",
+    )
+
+    parser.add_argument(
+        '--shard',
+        type=parse_shard,
+        metavar='INDEX/COUNT',
+        help="Split the files COUNT ways by size, and only format the "
+             "INDEX'th share (counting from 1).",
+    )
+
+    parser.add_argument(
+        '--staged',
+        action='store_true',
+        help="Format the Python files staged in git, and update them in the "
+             "index (and the working tree) if they change.",
+    )
+
+    parser.add_argument(
+        '--watch',
+        metavar='PATH',
+        action='append',
+        default=[],
+        help="Keep running, and reformat .py files under PATH as they change.",
+    )
+
+    parser.add_argument(
+        '--poll-interval',
+        type=float,
+        default=0.5,
+        help="How often --watch checks for changes, in seconds.",
+    )
+
     parser.add_argument(
         'source',
         type=argparse.FileType(),
@@ -37,37 +145,618 @@ def parse_args(args=None):
         help="Path to a Python source file, or '-' to read from stdin."
     )
 
-    return parser.parse_args(args)
+    args = parser.parse_args(args)
+
+    if args.shard and any(
+        f.fileno() == sys.stdin.fileno() for f in args.source
+    ):
+        parser.error("--shard can't split up stdin")
 
+    if args.staged and (args.source or args.watch or args.shard):
+        parser.error("--staged gets the files to format from git")
 
-def rewrite_file(f, args):
-    original_source = f.read()
+    return args
+
+
+def parse_shard(value):
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected INDEX/COUNT, like 1/4')
+
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(
+            'INDEX has to be between 1 and COUNT'
+        )
+
+    return index, count
+
+
+def shard_sources(sources, index, count):
+    # biggest files first, each onto whichever shard has the least so far.
+    # only sizes and names go into it (never the order files were listed
+    # in), so every node comes up with the same split without talking.
+    loads = [0] * count
+    assigned = {}
+
+    for size, name in sorted(
+        ((os.fstat(f.fileno()).st_size, f.name) for f in sources),
+        key=lambda item: (-item[0], item[1]),
+    ):
+        if name in assigned:
+            continue
+        shard = min(xrange(count), key=lambda i: (loads[i], i))
+        assigned[name] = shard
+        loads[shard] += size
+
+    mine = []
+    for f in sources:
+        if assigned[f.name] == index - 1:
+            mine.append(f)
+        else:
+            f.close()
+
+    return mine
+
+
+def rewrite_file(f, args, pool=None, stats=None, statements=None):
+    # stats, if given, gets filled in with what we did for the run report
+    if stats is None:
+        stats = {}
+
+    to_stdout = not args.in_place or f.fileno() == sys.stdin.fileno()
+
+    original_source, reason = read_source(f, args)
+    if reason is not None:
+        stats['skipped'] = reason
+
+        # in a pipe, whatever we leave alone still has to come out the other
+        # end (with the newline print used to add, same as everything else)
+        if to_stdout and not args.diff:
+            sys.stdout.write(original_source)
+            shutil.copyfileobj(f, sys.stdout)
+            sys.stdout.write('\n')
+            sys.stdout.flush()
+
+        return False
+
+    stats['bytes_in'] = len(original_source)
 
     # Make sure we have valid python
     if not args.no_validate:
         ast.parse(original_source)
 
-    new_source = indently.lib.format_source_code(original_source)
+    budget, cache, options = format_options(args, pool, statements)
+
+    if to_stdout and not args.diff:
+        # print used to tack on a newline, so keep doing that
+        new_source = write_incrementally(
+            itertools.chain(
+                tally(
+                    indently.lib.iter_format_source_code(
+                        original_source,
+                        **options
+                    ),
+                    original_source,
+                    stats,
+                ),
+                ['\n'],
+            ),
+            keep=not args.no_validate,
+        )
+        report_formatting(f.name, budget, cache, stats)
+
+        # this one's already gone out, but we can still fail loudly
+        if not args.no_validate:
+            ast.parse(new_source)
+
+        return False
+
+    new_source, edits = indently.lib.format_edits(original_source, **options)
+    stats['bytes_out'] = len(new_source)
+    stats['changed'] = new_source != original_source
+    report_formatting(f.name, budget, cache, stats)
 
     # Make sure we *still* have valid python
     if not args.no_validate:
         ast.parse(new_source)
 
-    if not args.in_place or f.fileno() == sys.stdin.fileno():
-        print new_source
-        return
+    if args.diff:
+        for line in indently.lib.unified_diff(original_source, edits, f.name):
+            sys.stdout.write(line)
+        sys.stdout.flush()
+        return new_source != original_source
 
     f.close()
 
-    with open(f.name, 'w') as ff:
-        ff.write(new_source)
+    # don't touch the file (and its mtime) if there's nothing to do
+    if new_source == original_source:
+        return False
+
+    # if it's been saved again while we were busy, that save wins. --watch
+    # sees it as a change and formats it next time around.
+    with open(f.name) as ff:
+        if ff.read() != original_source:
+            sys.stderr.write('%s changed while it was being formatted, left '
+                             'it alone\n' % f.name)
+            return False
+
+    write_atomically(f.name, new_source)
+
+    return True
+
+
+def format_options(args, pool=None, statements=None):
+    budget = None
+    if args.timeout is not None or args.statement_timeout is not None:
+        budget = indently.lib.Budget(
+            seconds=args.timeout,
+            statement_seconds=args.statement_timeout,
+        )
+
+    cache = indently.lib.LayoutCache(statements)
+
+    options = dict(
+        layout=args.layout,
+        tokenizer=args.tokenizer,
+        budget=budget,
+        pool=pool,
+        cache=cache,
+    )
+
+    return budget, cache, options
+
+
+# enough to see whatever header a generator put at the top
+HEADER_SIZE = 1024
+
+
+def read_source(f, args, size=None):
+    # returns the source along with why we're leaving it alone, if we are.
+    # big and generated files get turned away before we read them in full,
+    # so anything we don't return is still there to be read from f. size is
+    # looked up from f unless it's given.
+    if args.max_size is not None:
+        if size is None and f.fileno() != sys.stdin.fileno():
+            size = os.fstat(f.fileno()).st_size
+        if size is not None and size > args.max_size:
+            return '', 'bigger than %d bytes' % args.max_size
+
+    source = f.read(HEADER_SIZE)
+    if not args.include_generated and indently.lib.looks_generated(source):
+        return source, 'generated'
+
+    source += f.read()
+
+    for directive, _, _ in indently.lib.find_directives(source):
+        if directive == 'skip-file':
+            return source, 'skip-file directive'
+
+    return source, None
+
+
+def report_formatting(name, budget, cache, stats):
+    stats['cache_hits'] = cache.hits
+    stats['cache_misses'] = cache.misses
+    stats['statement_cache_hits'] = cache.statement_hits
+    stats['statement_cache_misses'] = cache.statement_misses
+    stats['statements_skipped'] = budget.skipped if budget else 0
+
+    if stats['statements_skipped']:
+        sys.stderr.write('partially formatted %s: left %d statement(s) '
+                         'alone\n' % (name, stats['statements_skipped']))
+
+
+def tally(chunks, original_source, stats):
+    # keeps track of what went out without having to hang on to any of it
+    stats['bytes_out'] = 0
+    stats['changed'] = False
+
+    for chunk in chunks:
+        start = stats['bytes_out']
+        if original_source[start:start + len(chunk)] != chunk:
+            stats['changed'] = True
+        stats['bytes_out'] += len(chunk)
+
+        yield chunk
+
+    if stats['bytes_out'] != len(original_source):
+        stats['changed'] = True
+
+
+def write_incrementally(chunks, out=None, keep=False, interval=0.05):
+    # source goes out as the raw bytes it came in as (we never decode it), so
+    # whatever encoding it's in comes out the other side untouched. the first
+    # piece is flushed straight away so whoever's downstream can get going,
+    # after that only every so often so it's not a write per statement.
+    if out is None:
+        sys.stdout.flush()
+        out = io.open(sys.stdout.fileno(), 'wb', closefd=False)
+
+    written = []
+    last_flush = None
+
+    for chunk in chunks:
+        out.write(chunk)
+        if keep:
+            written.append(chunk)
+
+        now = time.time()
+        if last_flush is None or now - last_flush >= interval:
+            out.flush()
+            last_flush = now
+
+    out.flush()
+
+    return ''.join(written)
+
+
+def write_atomically(path, source):
+    # write next to the original and rename over it, so nobody watching the
+    # file ever sees it half written. a symlink stays a link, we write to
+    # what it points at.
+    path = os.path.realpath(path)
+
+    # renaming would leave any other hard links with the old source, so those
+    # files are written in place instead
+    if os.stat(path).st_nlink > 1:
+        with open(path, 'w') as ff:
+            ff.write(source)
+        return
+
+    directory, name = os.path.split(path)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.%s.' % name)
+
+    try:
+        with os.fdopen(fd, 'w') as ff:
+            ff.write(source)
+        shutil.copymode(path, temp_path)
+        os.rename(temp_path, path)
+    except Exception:
+        os.unlink(temp_path)
+        raise
+
+
+def git(args, input=None, cwd=None):
+    process = subprocess.Popen(
+        ['git'] + args,
+        stdin=subprocess.PIPE if input is not None else None,
+        stdout=subprocess.PIPE,
+        cwd=cwd,
+    )
+    output, _ = process.communicate(input)
+
+    if process.returncode:
+        raise subprocess.CalledProcessError(
+            process.returncode,
+            ' '.join(['git'] + args),
+        )
+
+    return output
+
+
+def staged_files(root):
+    # (path, mode, blob) for every python file that's added or modified in
+    # the index. renames come out as an add, and symlinks and submodules
+    # aren't ours to format.
+    fields = git([
+        'diff', '--cached', '--raw', '-z', '--no-abbrev', '--no-renames',
+        '--diff-filter=AM', '--', '*.py',
+    ], cwd=root).split('\0')
+
+    staged = []
+    for info, path in zip(fields[0:-1:2], fields[1::2]):
+        _, mode, _, blob, _ = info.split(' ')
+        if mode in ('100644', '100755'):
+            staged.append((path, mode, blob))
+
+    return staged
+
+
+def read_blobs(root, blobs):
+    # one cat-file for all of them, straight out of the object database
+    output = git(
+        ['cat-file', '--batch'],
+        input=''.join(blob + '\n' for blob in blobs),
+        cwd=root,
+    )
+
+    contents = []
+    offset = 0
+    for _ in blobs:
+        header_end = output.index('\n', offset)
+        size = int(output[offset:header_end].split(' ')[2])
+        contents.append(output[header_end + 1:header_end + 1 + size])
+        offset = header_end + 1 + size + 1
+
+    return contents
+
+
+def format_staged_blob(job, pool=None, statements=None):
+    # may run in a worker, failures come back as values for main to sort out
+    path, source, args = job
+    stats = {}
+    start = time.time()
+
+    try:
+        original_source, reason = read_source(
+            io.BytesIO(source),
+            args,
+            size=len(source),
+        )
+        if reason is not None:
+            stats['skipped'] = reason
+            return path, None, None, stats, time.time() - start, None
+
+        stats['bytes_in'] = len(original_source)
+
+        if not args.no_validate:
+            ast.parse(original_source)
+
+        budget, cache, options = format_options(args, pool, statements)
+        new_source, edits = indently.lib.format_edits(
+            original_source,
+            **options
+        )
+        stats['bytes_out'] = len(new_source)
+        stats['changed'] = new_source != original_source
+        report_formatting(path, budget, cache, stats)
+
+        if not args.no_validate:
+            ast.parse(new_source)
+    except Exception as e:
+        return path, None, None, stats, time.time() - start, e
+
+    return path, new_source, edits, stats, time.time() - start, None
+
+
+def format_staged(args, report, pool=None, statements=None):
+    # what's about to be committed is what's in the index, so that's what we
+    # read and format, whatever state the working tree is in. only files
+    # that change get written back, to the index and (if it still matches
+    # what's staged) the working tree, so a commit hook touches as little as
+    # it can.
+    root = git(['rev-parse', '--show-toplevel']).rstrip('\n')
+
+    staged = staged_files(root)
+    sources = read_blobs(root, [blob for _, _, blob in staged])
+
+    jobs = [
+        (path, source, args)
+        for (path, _, _), source in zip(staged, sources)
+    ]
+    if statements is not None:
+        # the cache is only here, so files are formatted here one at a time
+        # and just the statements it misses go across the pool, like -i
+        results = (
+            format_staged_blob(job, pool, statements) for job in jobs
+        )
+    elif pool is None:
+        results = itertools.imap(format_staged_blob, jobs)
+    else:
+        results = pool.imap(format_staged_blob, jobs)
+
+    index_info = []
+    for (path, mode, _), source, result in zip(staged, sources, results):
+        _, new_source, edits, stats, seconds, error = result
+
+        if error is not None and not args.report:
+            raise error
+        status = file_status(path, stats, error)
+        report.add(path, status, seconds, stats)
+
+        if status != 'changed':
+            continue
+
+        if args.diff:
+            for line in indently.lib.unified_diff(source, edits, path):
+                sys.stdout.write(line)
+            continue
+
+        blob = git(
+            ['hash-object', '-w', '--stdin'],
+            input=new_source,
+            cwd=root,
+        ).strip()
+        index_info.append('%s %s\t%s\0' % (mode, blob, path))
+
+        # don't throw away anything that's changed since it was staged
+        working_path = os.path.join(root, path)
+        try:
+            with open(working_path) as f:
+                unstaged = f.read() != source
+        except IOError:
+            unstaged = True
+
+        if unstaged:
+            sys.stderr.write('%s has unstaged changes, only reformatted it '
+                             'in the index\n' % path)
+        else:
+            write_atomically(working_path, new_source)
+
+    sys.stdout.flush()
+
+    if index_info:
+        git(
+            ['update-index', '-z', '--index-info'],
+            input=''.join(index_info),
+            cwd=root,
+        )
+
+    return len(index_info)
+
+
+def file_status(name, stats, error=None):
+    if error is None:
+        if stats.get('skipped'):
+            return 'skipped'
+        return 'changed' if stats['changed'] else 'unchanged'
+
+    # bad input is skipped, bad output is on us
+    if isinstance(error, (IOError, SyntaxError)) and 'bytes_out' not in stats:
+        status = 'skipped'
+    else:
+        status = 'failed'
+    sys.stderr.write('%s %s: %s\n' % (status, name, error))
+
+    return status
+
+
+def find_python_files(paths):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for name in files:
+                if name.endswith('.py'):
+                    yield os.path.join(root, name)
+
+
+def snapshot(paths):
+    mtimes = {}
+
+    for path in find_python_files(paths):
+        try:
+            mtimes[path] = os.stat(path).st_mtime
+        except OSError:  # deleted out from under us
+            pass
+
+    return mtimes
+
+
+def watch(paths, args, debounce=0.2, pool=None, statements=None):
+    # polling keeps us portable, and is plenty fast for what editors do.
+    args.in_place = True
+    mtimes = snapshot(paths)
+
+    while True:
+        time.sleep(args.poll_interval)
+
+        current = snapshot(paths)
+        if current == mtimes:
+            continue
+
+        # editors like to save in bursts, wait for things to settle down
+        while True:
+            time.sleep(debounce)
+            settled = snapshot(paths)
+            if settled == current:
+                break
+            current = settled
+
+        mtimes = reformat_changed(current, mtimes, args, pool, statements)
+
+        if statements is not None:
+            statements.save()
+
+
+def reformat_changed(current, mtimes, args, pool=None, statements=None):
+    # formats everything in current that's changed since mtimes, and returns
+    # what to compare against next time: current, plus our own writes so we
+    # don't format them all over again. anything else saved while we were
+    # busy still looks changed next time around.
+    new_mtimes = dict(current)
+
+    for path in sorted(current):
+        if current[path] == mtimes.get(path):
+            continue
+
+        start = time.time()
+        try:
+            with open(path) as f:
+                changed = rewrite_file(
+                    f,
+                    args,
+                    pool=pool,
+                    statements=statements,
+                )
+            if changed:
+                new_mtimes[path] = os.stat(path).st_mtime
+        except Exception as e:
+            # whatever's wrong with this one, keep watching the rest
+            sys.stderr.write('skipped %s: %s\n' % (path, e))
+            continue
+
+        sys.stderr.write('%s %s in %.1fms\n' % (
+            'reformatted' if changed else 'checked',
+            path,
+            (time.time() - start) * 1000,
+        ))
+
+    return new_mtimes
 
 
 def main():
     args = parse_args()
 
-    for source in args.source:
-        rewrite_file(source, args)
+    pool = None
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs)
+
+    statements = None
+    if args.cache:
+        statements = indently.lib.StatementCache(args.cache)
+
+    if args.watch:
+        try:
+            watch(args.watch, args, pool=pool, statements=statements)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    report = indently.report.RunReport()
+    report.shard = args.shard
+
+    if args.staged:
+        # files go across the pool here, rather than statements, unless
+        # there's a cache to check them against
+        num_changed = format_staged(args, report, pool, statements)
+    else:
+        num_changed = rewrite_files(args, report, pool, statements)
+
+    if statements is not None:
+        statements.save()
+
+    if args.in_place or args.staged and not args.diff:
+        sys.stderr.write('%d file(s) reformatted\n' % num_changed)
+
+    num_partial = report.to_dict()['files']['partial']
+    if num_partial:
+        sys.stderr.write('%d file(s) partially formatted\n' % num_partial)
+
+    if args.report:
+        report.write(args.report)
+        if report.count('failed'):
+            sys.exit(1)
+
+
+def rewrite_files(args, report, pool=None, statements=None):
+    sources = args.source
+    if args.shard:
+        sources = shard_sources(sources, *args.shard)
+
+    num_changed = 0
+
+    for source in sources:
+        stats = {}
+        start = time.time()
+
+        try:
+            num_changed += rewrite_file(source, args, pool, stats, statements)
+        except Exception as e:
+            # with a report to write, one bad file shouldn't cost us the rest
+            if not args.report:
+                raise
+            status = file_status(source.name, stats, e)
+        else:
+            status = file_status(source.name, stats)
+
+        report.add(source.name, status, time.time() - start, stats)
+
+    return num_changed
 
 
 if __name__ == '__main__':
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 from setuptools import setup
 from setuptools import Command
+import os
 import sys
 
 
@@ -22,12 +23,33 @@ class Tox(Command):
         sys.exit(errno)
 
 
+def ext_modules():
+    # INDENTLY_CYTHON=1 compiles indently.lib with Cython (mypyc can't, it
+    # only does python 3). lib.py gets installed either way, for anywhere
+    # the compiled one won't load.
+    if not os.environ.get('INDENTLY_CYTHON'):
+        return []
+
+    from Cython.Build import cythonize
+
+    return cythonize(
+        ['indently/lib.py'],
+        compiler_directives={
+            'language_level': 2,
+            # so layout functions can still be pickled over to a process
+            # pool
+            'binding': True,
+        },
+    )
+
+
 setup(
     name='indently',
     version='0.0.1',
     author='Bryce Lampe',
     description='Tool to automatically format Python code.',
     packages=['indently'],
+    ext_modules=ext_modules(),
     entry_points={
         'console_scripts': [
             'indently = indently.script:main',
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import math
+import os
+import sys
+import timeit
+
+import pytest
+
+from indently import benchmark
+from indently import lib
+
+
+# each axis grows one feature of the input, and we check how fast the work
+# grows along with it: the k in work ~ size**k. outputs are checked over in
+# lib_test.py, this is just here to catch something going quadratic.
+LINEAR = 1
+QUADRATIC = 2
+
+# work is counted in lines of lib run, which come out the same every time.
+# constant overheads and n log n still move k a little.
+SLACK = 0.25
+
+# wall clock timings jitter (more so on a busy CI box), so they're only
+# checked when asked for, with more slack.
+TIMED = bool(os.environ.get('INDENTLY_TIMED'))
+TIMED_SLACK = 0.5
+TIMED_SCALE = 4
+
+GROWTH = 4
+
+
+AXES = {
+    'line_length': lambda n: 'x = ' + ' + '.join(['a'] * n) + '\n',
+    'arguments': lambda n: 'foo(' + ', '.join(
+        'a%d=%d' % (i, i) for i in xrange(n)
+    ) + ')\n',
+    # every level is indented further than the last, so the output alone is
+    # quadratic in the depth. none of them fit on one line either, otherwise
+    # we'd be timing where the layout switches over instead.
+    'nesting': lambda n: 'x = ' + '[%s, ' % ('a' * 40) * n + '1' + (
+        ']' * n
+    ) + '\n',
+    'strings': lambda n: ''.join(
+        "s%d = '%s'\n" % (i, 'a' * 100) for i in xrange(n)
+    ),
+    'comments': lambda n: ''.join(
+        "x%d = 1  # %s\n" % (i, 'word ' * 20) for i in xrange(n)
+    ),
+    'backslashes': lambda n: 'x = 1 \\\n' + ''.join(
+        '    + %d \\\n' % i for i in xrange(n)
+    ) + '    + 0\n',
+}
+
+SIZES = {
+    'nesting': 10,
+}
+
+BOUNDS = {
+    ('nesting', 'greedy'): QUADRATIC,
+    ('nesting', 'optimal'): QUADRATIC,
+}
+
+# the python source has to be what runs for its lines to be counted, so a
+# compiled build gets the pure lib.py installed alongside it
+pure_lib = benchmark.load_pure_lib() if benchmark.is_compiled(lib) else lib
+
+
+class StepCounter(object):
+    # quacks like a lib.Budget that never runs out
+
+    skipped = 0
+
+    def __init__(self):
+        self.steps = 0
+
+    def start_statement(self):
+        pass
+
+    def spend(self):
+        self.steps += 1
+
+
+def lines_run(func, arg):
+    count = [0]
+
+    def count_lines(frame, event, _):
+        if event == 'line':
+            count[0] += 1
+        return count_lines
+
+    def trace(frame, event, _):
+        if frame.f_globals is vars(pure_lib):
+            return count_lines
+
+    sys.settrace(trace)
+    try:
+        func(arg)
+    finally:
+        sys.settrace(None)
+
+    return count[0]
+
+
+def seconds(func, arg):
+    # like timeit's autorange, so quick calls aren't lost in the noise
+    number = 1
+    while timeit.timeit(lambda: func(arg), number=number) < 0.01:
+        number *= 2
+
+    return min(
+        timeit.repeat(lambda: func(arg), number=number, repeat=3)
+    ) / number
+
+
+def growth(small, large):
+    return math.log(float(large) / small) / math.log(GROWTH)
+
+
+def work_growth(func, axis, timed=False):
+    size = SIZES.get(axis, 50)
+    make_input = AXES[axis]
+    measure = lines_run
+
+    if timed:
+        size *= TIMED_SCALE
+        measure = seconds
+
+    return growth(
+        measure(func, make_input(size)),
+        measure(func, make_input(size * GROWTH)),
+    )
+
+
+def check_growth(func, axis, bound, timed):
+    if timed and not TIMED:
+        pytest.skip('wall clock timings are only checked with INDENTLY_TIMED')
+
+    slack = TIMED_SLACK if timed else SLACK
+    assert work_growth(func, axis, timed) < bound + slack
+
+
+@pytest.mark.parametrize('timed', [False, True])
+@pytest.mark.parametrize('axis', sorted(AXES))
+def test_parse_code_is_linear(axis, timed):
+    def parse_code(source_code):
+        return list(pure_lib.parse_code(source_code))
+
+    check_growth(parse_code, axis, LINEAR, timed)
+
+
+@pytest.mark.parametrize('timed', [False, True])
+@pytest.mark.parametrize('axis', sorted(AXES))
+@pytest.mark.parametrize('layout', sorted(lib.LAYOUTS))
+def test_format_source_code_growth(axis, layout, timed):
+    def format_source_code(source_code):
+        return pure_lib.format_source_code(source_code, layout=layout)
+
+    check_growth(
+        format_source_code,
+        axis,
+        BOUNDS.get((axis, layout), LINEAR),
+        timed,
+    )
+
+
+@pytest.mark.parametrize('timed', [False, True])
+def test_extract_args_is_linear(timed):
+    def extract_args(source_code):
+        return pure_lib.extract_args(source_code[3:-1])
+
+    check_growth(extract_args, 'arguments', LINEAR, timed)
+
+
+@pytest.mark.parametrize('axis, bound', [
+    ('arguments', LINEAR),
+    ('nesting', QUADRATIC),
+])
+def test_layout_steps(axis, bound):
+    # step counts don't jitter, so these bounds are exact
+    def steps(size):
+        counter = StepCounter()
+        lib.format_source_code(AXES[axis](size), budget=counter)
+        return counter.steps
+
+    size = SIZES.get(axis, 200)
+
+    assert growth(steps(size), steps(size * GROWTH)) <= bound
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import time
+
+import pytest
+
+from indently import executor
+from indently import lib
+
+
+source_code = "foo = bar(\n    a=1, b=2)\n"
+slow_source_code = open(
+    os.path.join(os.path.dirname(lib.__file__), 'lib.py')
+).read() * 3
+
+
+@pytest.mark.parametrize('processes', [False, True])
+def test_format(processes):
+    with executor.FormatExecutor(workers=2, processes=processes) as e:
+        result = e.format(source_code).result()
+
+    assert lib.format_source_code(source_code) == result
+
+
+def test_format_many_keeps_order():
+    sources = [source_code, "x = [\n1]\n", source_code]
+
+    with executor.FormatExecutor(workers=2) as e:
+        result = list(e.format_many(sources, layout='optimal'))
+
+    assert [
+        lib.format_source_code(s, layout='optimal')
+        for s in sources
+    ] == result
+
+
+def test_format_many_hands_out_a_window_at_a_time():
+    pulled = []
+
+    def sources():
+        for i in xrange(100):
+            pulled.append(i)
+            yield source_code
+
+    with executor.FormatExecutor(workers=2) as e:
+        results = e.format_many(sources(), window=3)
+        assert lib.format_source_code(source_code) == results.next()
+
+        assert len(pulled) <= 4
+        results.close()
+
+
+def test_format_many_cancels_the_rest_when_one_fails(monkeypatch):
+    formatted = []
+    format_source_code = lib.format_source_code
+
+    def fail_on_bad_input(source_code, **options):
+        formatted.append(source_code)
+        if source_code == 'bad':
+            raise ValueError(source_code)
+        return format_source_code(source_code, **options)
+
+    monkeypatch.setattr(lib, 'format_source_code', fail_on_bad_input)
+
+    with executor.FormatExecutor(workers=1) as e:
+        results = e.format_many(['bad', 'a = 1\n', 'b = 1\n'], window=2)
+        with pytest.raises(ValueError):
+            results.next()
+
+        e.pool.close()
+        e.pool.join()
+
+    # the one behind it might have been started already, but no more
+    assert 'b = 1\n' not in formatted
+
+
+def test_format_times_out():
+    with executor.FormatExecutor(workers=1) as e:
+        future = e.format(slow_source_code, timeout=0.01)
+
+        with pytest.raises(executor.FormatTimeout):
+            future.result()
+
+
+def test_format_stops_working_at_the_timeout():
+    unformatted = ''.join(
+        'x%d = foo(\n    a=%d, b=2)\n' % (i, i) for i in xrange(5000)
+    )
+
+    with executor.FormatExecutor(workers=1) as e:
+        future = e.format(unformatted, timeout=0.01)
+
+        with pytest.raises(executor.FormatTimeout):
+            future.result()
+
+        # the worker gives up too, and leaves the rest as it was
+        while not future.done():
+            time.sleep(0.01)
+        result = future.result()
+
+    assert result.endswith('x4999 = foo(\n    a=4999, b=2)\n')
+
+
+def test_format_timeout_counts_time_spent_queued():
+    unformatted = ''.join(
+        'x%d = foo(\n    a=%d, b=2)\n' % (i, i) for i in xrange(40000)
+    )
+    finished = {}
+
+    with executor.FormatExecutor(workers=1) as e:
+        started = time.time()
+        e.format(unformatted, timeout=1.0)
+
+        # only gets the worker once the first is done with it, just before
+        # its own time's up
+        future = e.format(unformatted, timeout=1.2)
+        future.add_done_callback(
+            lambda f: finished.setdefault('at', time.time())
+        )
+
+        while 'at' not in finished:
+            time.sleep(0.01)
+
+    assert finished['at'] - started < 2.0
+
+
+def test_format_doesnt_start_after_the_timeout():
+    ok, error = executor._format(source_code, {}, deadline=time.time() - 1)
+
+    assert not ok
+    assert isinstance(error, executor.FormatTimeout)
+
+
+def test_format_can_be_cancelled():
+    with executor.FormatExecutor(workers=1) as e:
+        e.format(slow_source_code)
+        future = e.format(source_code)
+
+        called = []
+        future.add_done_callback(called.append)
+
+        assert future.cancel()
+
+        with pytest.raises(executor.FormatCancelled):
+            future.result()
+
+    assert [future] == called
@@ -1,9 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import multiprocessing
 import os
+import pdb
+import pickle
+import shutil
+import sysconfig
 
 import pytest
 
+from indently import benchmark
 from indently import lib
 
 
@@ -362,6 +368,68 @@ def test_format_source_code_handles_utf8_source():
     assert expected == result
 
 
+def test_format_source_code_handles_deeply_nested_literals():
+    source_code = "x = " + "[" * 60 + "1, 2" + "]" * 60 + "\n"
+
+    result = lib.format_source_code(source_code)
+
+    assert result.startswith("x = [\n    [\n        [\n")
+    assert eval(result[4:]) == eval(source_code[4:])
+
+
+def test_format_source_code_handles_deeply_nested_calls():
+    source_code = "x = " + "f(a, " * 300 + "b" + ")" * 300 + "\n"
+
+    result = lib.format_source_code(source_code)
+
+    assert result.startswith("x = f(\n    a,\n    f(\n        a,\n")
+    assert ''.join(result.split()) == ''.join(source_code.split())
+
+
+def test_format_source_code_doesnt_join_strings_onto_triple_quotes():
+    source_code = "x = f(g['''a''' 'b'], %s)\n" % ('y' * 70)
+
+    result = lib.format_source_code(source_code)
+
+    assert "'''a''' 'b'" in result
+
+
+DATA_LITERALS = [
+    "[1, 2, 3]",
+    "( 1 , )",
+    "{'a': [1, 2], 'b': {'c': (True, None)}, 'd': -1.5e-3,}",
+    "[\n    1,\n    2,\n]",
+    "[u'%s', r'%s']" % ('x' * 40, 'y' * 40),
+    "{'k%d': [%s]}" % (1, ', '.join(str(i) for i in range(40))),
+    "[[[1, 2], [3, 4]], [[5, 6], [7, 8]]]",
+    "['%s']" % ('z' * 100),
+]
+
+
+@pytest.mark.parametrize('bracket_body', DATA_LITERALS)
+@pytest.mark.parametrize('indent, offset', [('', 0), ('    ', 40), ('', 70)])
+def test_layout_data_matches_rewrite_bracket(
+    monkeypatch, bracket_body, indent, offset,
+):
+    result = lib._layout_data(bracket_body, indent, offset)
+    assert result is not None
+
+    monkeypatch.setattr(lib, '_layout_data', lambda *args: None)
+    assert lib.rewrite_bracket(bracket_body, indent, offset) == result
+
+
+@pytest.mark.parametrize('bracket_body', [
+    "[a, b]",
+    "[1,  # one\n 2]",
+    "[x for x in y]",
+    "['a' 'b']",
+    "[1 if x else 2]",
+    "{**a}",
+])
+def test_layout_data_leaves_everything_else_alone(bracket_body):
+    assert lib._layout_data(bracket_body, '', 0) is None
+
+
 def test_parse_code_handles_string_context_correctly():
     source_code = "'''this shouldn\\'t be two strings''' (a=1)"
 
@@ -413,6 +481,74 @@ def test_parse_code_handles_double_backslashes():
     assert "'\\\\'" == result[1].value
 
 
+def test_code_subtokens():
+    code = list(lib.parse_code("(a and b.c, 1)"))[0]
+
+    result = [(type(t).__name__, t.value, t.offset) for t in code.subtokens]
+
+    assert [
+        ('Operator', '(', 0),
+        ('Name', 'a', 1),
+        ('Whitespace', ' ', 2),
+        ('Keyword', 'and', 3),
+        ('Whitespace', ' ', 6),
+        ('Name', 'b', 7),
+        ('Operator', '.', 8),
+        ('Name', 'c', 9),
+        ('Operator', ',', 10),
+        ('Whitespace', ' ', 11),
+        ('Name', '1', 12),
+        ('Operator', ')', 13),
+    ] == result
+
+
+def test_parse_code_tokenize_matches_parse_code():
+    source_code = """
+    x = u'foo' + r"(bar)"  # a comment, with (brackets)
+    y = '''(triple)'''
+    """
+
+    expected = [
+        (type(t), t.value, t.offset)
+        for t in lib.parse_code(source_code)
+    ]
+
+    result = [
+        (type(t), t.value, t.offset)
+        for t in lib.parse_code_tokenize(source_code)
+    ]
+
+    assert expected == result
+
+
+def test_parse_code_tokenize_falls_back_on_fragments():
+    source_code = "foo(a, 'b'"
+
+    result = [t.value for t in lib.parse_code_tokenize(source_code)]
+
+    assert ['foo(a, ', "'b'"] == result
+
+
+def test_format_source_code_with_tokenize_backend():
+    source_code = """
+    models.Membership.objects.filter(account__in=owner, active=True, created__lte='2014-01-01').select_related('user').distinct().order_by('id')
+    """
+
+    expected = lib.format_source_code(source_code)
+
+    result = lib.format_source_code(source_code, tokenizer='tokenize')
+
+    assert expected == result
+
+
+def test_extract_args_splits_on_keywords_outside_brackets():
+    bracket_body = "(a  and f(b or c) or d if e else\n g)"
+
+    result = lib.extract_args(bracket_body)
+
+    assert ['a', 'and f(b or c)', 'or d', 'if e', 'else g'] == result
+
+
 def test_format_source_code_handles_string_continuations_in_parens():
     source_code = """
         foo = (
@@ -454,6 +590,30 @@ def test_format_source_code_wraps_long_strings():
     assert expected == result
 
 
+def test_format_source_code_wraps_long_strings_next_to_other_brackets():
+    source_code = """
+        foo = 'aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaabcccccccc'
+        bar(x=1, y='aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaabbbbbbbbbbbbb')
+    """
+    expected = """
+        foo = (
+            'aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaab'
+            'cccccccc'
+        )
+        bar(
+            x=1,
+            y=(
+                'aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa'
+                'bbbbbbbbbbbbb'
+            )
+        )
+    """
+
+    result = lib.format_source_code(source_code)
+
+    assert expected == result
+
+
 def test_format_source_code_wraps_long_strings_but_also_handles_backslashes():
     source_code = """
         foo = 'aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaabcccccccc' \\
@@ -472,6 +632,26 @@ def test_format_source_code_wraps_long_strings_but_also_handles_backslashes():
     assert expected == result
 
 
+@pytest.mark.parametrize('layout', sorted(lib.LAYOUTS))
+def test_format_source_code_doesnt_wrap_prefixed_strings(layout):
+    # split_string can't do anything with these, so a bracket won't help
+    source_code = """
+        foo = r'aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa'
+        bar(x=1, y=u'aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa')
+    """
+    expected = """
+        foo = r'aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa'
+        bar(
+            x=1,
+            y=u'aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa'
+        )
+    """
+
+    result = lib.format_source_code(source_code, layout=layout)
+
+    assert expected == result
+
+
 def test_format_source_code_doesnt_kill_strings_that_it_cant_fix():
     source_code = """
                                                                                          foo('bar')
@@ -785,7 +965,514 @@ def test_long_boolean_expressions_that_fit_within_line_limit():
     assert expected == result
 
 
+def test_optimal_layout():
+    source_code = """
+    models.Membership.objects.filter(account__in=owner, active=True, created__lte='2014-01-01').select_related('user').distinct().order_by('id')
+    foo = bar(a=1, # first
+        b=2, # second
+    )
+    """
+    expected = """
+    models.Membership.objects.filter(
+        account__in=owner,
+        active=True,
+        created__lte='2014-01-01'
+    ).select_related('user').distinct().order_by('id')
+    foo = bar(
+        a=1,
+        # first
+        b=2,
+        # second
+    )
+    """
+
+    result = lib.format_source_code(source_code, layout='optimal')
+
+    assert expected == result
+    assert expected == lib.format_source_code(result, layout='optimal')
+
+
+def test_optimal_layout_handles_deeply_nested_literals():
+    source_code = "x = " + "[" * 300 + "1, 2" + "]" * 300 + "\n"
+
+    result = lib.format_source_code(source_code, layout='optimal')
+
+    assert result.startswith("x = [\n    [\n        [\n")
+    assert "".join(result.split()) == "".join(source_code.split())
+
+
+def test_format_edits():
+    source_code = """
+    foo = bar(
+        a=1, b=2)  # a comment that runs on for long enough that it needs wrapping
+    x = \\
+        1
+    """
+
+    result, edits = lib.format_edits(source_code)
+
+    assert lib.format_source_code(source_code) == result
+    assert result == lib._apply_edits(source_code, edits)
+
+
+@pytest.mark.parametrize('layout', sorted(lib.LAYOUTS))
+def test_format_edits_matches_layout(layout):
+    source_code = """
+    models.Membership.objects.filter(account__in=owner, active=True, created__lte='2014-01-01').select_related('user').distinct().order_by('id')
+    foo = 'aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaabcccccccc'
+    """
+
+    result, edits = lib.format_edits(source_code, layout=layout)
+
+    assert lib.format_source_code(source_code, layout=layout) == result
+    assert result == lib._apply_edits(source_code, edits)
+
+
+def test_format_edits_are_minimal():
+    source_code = "x = 1\nfoo = bar(\n    a=1, b=2)\n"
+
+    result, edits = lib.format_edits(source_code)
+
+    assert [(16, 21, '')] == edits
+    assert result == lib.apply_edits(source_code, edits)
+
+
+def test_minimal_edits():
+    source_code = "abcdef"
+
+    assert [(2, 3, 'X')] == lib.minimal_edits(source_code, [(1, 5, 'bXde')])
+    assert [(3, 3, 'Y')] == lib.minimal_edits(source_code, [(1, 5, 'bcYde')])
+    assert [] == lib.minimal_edits(source_code, [(1, 5, 'bcde')])
+
+
+def test_apply_edits_checks_edits():
+    with pytest.raises(ValueError):
+        lib.apply_edits("abcdef", [(3, 4, ''), (1, 2, '')])
+
+    with pytest.raises(ValueError):
+        lib.apply_edits("abcdef", [(3, 10, '')])
+
+
+def test_compose_edits():
+    source_code = "abcdefgh"
+    first = [(1, 3, 'XY'), (5, 5, 'Z')]
+    middle = lib._apply_edits(source_code, first)
+    second = [(0, 2, ''), (4, 7, 'W')]
+
+    result = lib._compose_edits(first, second, middle)
+
+    assert lib._apply_edits(middle, second) == lib._apply_edits(
+        source_code,
+        result,
+    )
+
+
+@pytest.mark.parametrize('tokenizer', sorted(lib.TOKENIZERS))
+def test_edit_buffer(tokenizer):
+    source_code = (
+        "x = 'abc'  # one\n"
+        "foo(a, 'b', [c])\n"
+        "# two\n"
+        "y = 2\n"
+    )
+    buffer = lib.EditBuffer(source_code, tokenizer)
+
+    first = [(4, 4, '('), (9, 9, ')'), (26, 26, ' ')]
+    buffer.apply(first)
+    second = [(0, 1, 'z'), (20, 23, '"b"'), (40, 46, 'y = 3')]
+    buffer.apply(second)
+
+    expected = lib._apply_edits(lib._apply_edits(source_code, first), second)
+    assert expected == buffer.source_code
+    assert expected == lib._apply_edits(source_code, buffer.edits)
+
+    # same tokens as scanning it all over again
+    assert repr(list(lib.TOKENIZERS[tokenizer](expected))) == repr(
+        buffer.tokens
+    )
+
+
+def test_edit_buffer_when_tokenize_gives_up():
+    # parse_code and tokenize disagree on this string, and once the source
+    # stops tokenizing it's parse_code's say for all of it
+    source_code = "x = '\\\\\\''\ny = 1\n"
+    buffer = lib.EditBuffer(source_code, 'tokenize')
+    buffer.tokens
+
+    buffer.apply([(len(source_code), len(source_code), 'z = (\n')])
+
+    assert repr(list(lib.parse_code(buffer.source_code))) == repr(
+        buffer.tokens
+    )
+
+
+def test_unified_diff():
+    source_code = "a = 1\nb = 2\nfoo = bar(\n    a=1, b=2)\nc = 3\nd = 4\n"
+
+    result, edits = lib.format_edits(source_code)
+
+    assert ''.join(lib.unified_diff(source_code, edits, 'foo.py')) == (
+        "--- a/foo.py\n"
+        "+++ b/foo.py\n"
+        "@@ -1,6 +1,5 @@\n"
+        " a = 1\n"
+        " b = 2\n"
+        "-foo = bar(\n"
+        "-    a=1, b=2)\n"
+        "+foo = bar(a=1, b=2)\n"
+        " c = 3\n"
+        " d = 4\n"
+    )
+
+
+def test_unified_diff_without_changes():
+    assert [] == list(lib.unified_diff("a = 1\n", [], 'foo.py'))
+
+
+@pytest.mark.parametrize('layout', sorted(lib.LAYOUTS))
+def test_budget_leaves_expensive_statements_alone(layout):
+    source_code = """
+    x = [[[[[[[[a, 2], 3], 4], 5], 6], 7], 8],
+    9]
+    foo = bar(
+        a=1, b=2)
+    """
+    expected = """
+    x = [[[[[[[[a, 2], 3], 4], 5], 6], 7], 8],
+    9]
+    foo = bar(a=1, b=2)
+    """
+
+    budget = lib.Budget(statement_steps=4)
+    result, edits = lib.format_edits(
+        source_code,
+        layout=layout,
+        budget=budget,
+    )
+
+    assert expected == result
+    assert 1 == budget.skipped
+    assert budget.partial
+    assert result == lib._apply_edits(source_code, edits)
+
+
+@pytest.mark.parametrize('layout', sorted(lib.LAYOUTS))
+def test_budget_for_the_whole_file(layout):
+    source_code = "foo = bar(\n    a=1, b=2)\ns = '%s'\n" % ('a' * 90)
+
+    budget = lib.Budget(seconds=0)
+    result = lib.format_source_code(source_code, layout, budget=budget)
+
+    assert source_code == result
+    # optimal doesn't put long strings in brackets of their own
+    assert {'greedy': 2, 'optimal': 1}[layout] == budget.skipped
+
+    budget = lib.Budget(seconds=60, statement_seconds=60)
+    result = lib.format_source_code(source_code, layout, budget=budget)
+
+    assert lib.format_source_code(source_code, layout) == result
+    assert not budget.partial
+
+
+@pytest.mark.parametrize('layout', sorted(lib.LAYOUTS))
+def test_iter_format_source_code(layout):
+    source_code = """
+    foo = bar(
+        a=1, b=2)  # a comment that runs on for long enough that it needs wrapping
+    x = '''
+(not a bracket
+'''
+    s = 'aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa'
+    if (a or
+        b):
+        y = [1,
+    2]
+    """
+
+    result = list(lib.iter_format_source_code(source_code, layout=layout))
+
+    assert lib.format_source_code(source_code, layout=layout) == ''.join(
+        result
+    )
+    if layout == 'greedy':
+        assert len(result) > 1
+
+
+@pytest.mark.parametrize('module', [sysconfig, shutil, pdb])
+@pytest.mark.parametrize('tokenizer', sorted(lib.TOKENIZERS))
+def test_iter_format_source_code_matches_on_the_stdlib(module, tokenizer):
+    source_code = open(os.path.splitext(module.__file__)[0] + '.py').read()
+
+    result = ''.join(
+        lib.iter_format_source_code(source_code, tokenizer=tokenizer)
+    )
+
+    assert lib.format_source_code(source_code, tokenizer=tokenizer) == result
+
+
+def test_format_source_code_leaves_off_regions_alone():
+    source_code = """
+    foo = bar(
+        a=1, b=2)
+    # indently: off
+    keep = bar(
+        a=1, b=2)
+    x = 1 + \\
+        2
+    # indently: on
+    foo = bar(
+        a=1, b=2)
+    """
+    expected = """
+    foo = bar(a=1, b=2)
+    # indently: off
+    keep = bar(
+        a=1, b=2)
+    x = 1 + \\
+        2
+    # indently: on
+    foo = bar(a=1, b=2)
+    """
+
+    result, edits = lib.format_edits(source_code)
+
+    assert expected == result
+    assert result == lib._apply_edits(source_code, edits)
+    assert result == ''.join(lib.iter_format_source_code(source_code))
+
+
+def test_format_source_code_leaves_the_rest_off():
+    source_code = "foo = bar(\n    a=1)\n# indently: off\nfoo = bar(\n    a=1)\n"
+    expected = "foo = bar(a=1)\n# indently: off\nfoo = bar(\n    a=1)\n"
+
+    result = lib.format_source_code(source_code)
+
+    assert expected == result
+
+
+def test_format_source_code_with_skip_file():
+    source_code = "foo = bar(\n    a=1)\n# indently: skip-file\n"
+
+    result = lib.format_source_code(source_code)
+
+    assert source_code == result
+
+
+def test_directives_in_brackets_dont_count():
+    source_code = "foo = bar(  # indently: off\n    a=1)\n"
+
+    assert [] == list(lib.find_directives(source_code))
+
+
+def test_looks_generated():
+    assert lib.looks_generated(
+        "# Generated by the protocol buffer compiler.  DO NOT EDIT!\n"
+    )
+    assert lib.looks_generated(
+        "# -*- coding: utf-8 -*-\n# Generated by Django 1.11 on 2017-01-01\n"
+    )
+    assert lib.looks_generated("#!/usr/bin/env python\n# @generated\n")
+    assert not lib.looks_generated("import os\n")
+
+
+def test_looks_generated_only_goes_by_comments():
+    assert not lib.looks_generated(
+        '"""Helpers for code generated by the build. DO NOT EDIT it."""\n'
+    )
+    assert not lib.looks_generated(
+        "x = 1\n" * 5 + "# Generated by Django 1.11 on 2017-01-01\n"
+    )
+    assert not lib.looks_generated(
+        "# TODO: this was generated by hand, tidy it up\n"
+    )
+    assert not lib.looks_generated(
+        "# the autogenerated bits live in schema_pb2.py\n"
+    )
+
+
+def test_format_many():
+    sources = [
+        "foo = bar(\n    a=1, b=2)\n",
+        "x = 1\n",
+        "baz = bar(\n    a=1, b=2)\n",
+        "foo = bar(\n    a=1, b=2)\n",
+    ]
+    cache = lib.LayoutCache()
+
+    result = lib.format_many(iter(sources), cache=cache)
+
+    assert (lib.format_source_code(sources[0]), True) == result.next()
+    assert ("x = 1\n", False) == result.next()
+
+    # bar(...) was laid out for the first source already, so there's nothing
+    # new to lay out
+    misses = cache.misses
+    assert (lib.format_source_code(sources[2]), True) == result.next()
+    assert misses == cache.misses
+
+    misses = cache.misses
+    assert (lib.format_source_code(sources[3]), True) == result.next()
+    assert misses == cache.misses
+
+
+def test_format_many_starts_over_when_its_cache_fills_up(monkeypatch):
+    monkeypatch.setattr(lib, 'FORMAT_MANY_CACHE_BYTES', 1)
+    sources = [
+        u"foo = bar(\n    a=1, b=u'\xe9')\n",
+        "x = 1\n",
+        u"foo = bar(\n    a=1, b=u'\xe9')\n",
+    ]
+    cache = lib.LayoutCache()
+
+    result = list(lib.format_many(iter(sources), cache=cache))
+
+    assert [
+        (lib.format_source_code(source), source != 'x = 1\n')
+        for source in sources
+    ] == result
+
+    # by the time the first one comes around again it's been forgotten, so
+    # bar(...) gets laid out all over again
+    assert (0, 2) == (cache.hits, cache.misses)
+
+
+def test_layout_cache():
+    source_code = "foo(bar(1, 2))\nfoo(bar(1, 2))\n"
+    cache = lib.LayoutCache()
+
+    result = lib.format_source_code(source_code, cache=cache)
+
+    assert lib.format_source_code(source_code) == result
+    assert cache.misses == len(cache)
+    assert cache.hits > 0
+
+
+def test_statement_cache(tmpdir):
+    path = str(tmpdir.join('cache'))
+    source_code = "a = foo(\n    1, 2)\nb = bar(\n    3, 4)\nc = baz(5)\n"
+
+    statements = lib.StatementCache(path)
+    result = lib.format_source_code(
+        source_code,
+        cache=lib.LayoutCache(statements),
+    )
+    assert lib.format_source_code(source_code) == result
+    assert 3 == statements.misses
+    statements.save()
+
+    # next time around only the statement that changed gets laid out
+    edited = source_code.replace('3, 4', '3, 5')
+    statements = lib.StatementCache(path)
+    result = lib.format_source_code(
+        edited,
+        cache=lib.LayoutCache(statements),
+    )
+    assert lib.format_source_code(edited) == result
+    assert (2, 1) == (statements.hits, statements.misses)
+
+
+def test_statement_cache_handles_unicode(tmpdir):
+    path = str(tmpdir.join('cache'))
+    source_code = u"x = f(\n    u'\xe9')\n"
+
+    statements = lib.StatementCache(path)
+    result = lib.format_source_code(
+        source_code,
+        cache=lib.LayoutCache(statements),
+    )
+    assert lib.format_source_code(source_code) == result
+    statements.save()
+
+    statements = lib.StatementCache(path)
+    assert result == lib.format_source_code(
+        source_code,
+        cache=lib.LayoutCache(statements),
+    )
+    assert (1, 0) == (statements.hits, statements.misses)
+
+    # the same statement as utf-8 bytes doesn't get the unicode layout back
+    encoded = lib.format_source_code(
+        source_code.encode('utf-8'),
+        cache=lib.LayoutCache(statements),
+    )
+    assert isinstance(encoded, str)
+    assert result.encode('utf-8') == encoded
+
+
+def test_statement_cache_from_another_version(tmpdir, monkeypatch):
+    path = str(tmpdir.join('cache'))
+    source_code = "a = foo(1, 2)\n"
+
+    statements = lib.StatementCache(path)
+    lib.format_source_code(source_code, cache=lib.LayoutCache(statements))
+    statements.save()
+
+    monkeypatch.setattr(lib, '_formatter_version', lambda: 'newer')
+    statements = lib.StatementCache(path)
+    lib.format_source_code(source_code, cache=lib.LayoutCache(statements))
+
+    assert (0, 1) == (statements.hits, statements.misses)
+
+
+LOADED = []
+
+
+def load_payload():
+    LOADED.append(True)
+
+
+class Payload(object):
+    # runs load_payload as soon as it's unpickled
+
+    def __reduce__(self):
+        return load_payload, ()
+
+
+def test_statement_cache_doesnt_unpickle(tmpdir):
+    path = tmpdir.join('cache')
+    path.write(pickle.dumps((lib._formatter_version(), Payload())), 'wb')
+
+    statements = lib.StatementCache(str(path))
+    lib.format_source_code(
+        "a = foo(1, 2)\n",
+        cache=lib.LayoutCache(statements),
+    )
+
+    assert not LOADED
+    assert (0, 1) == (statements.hits, statements.misses)
+
+
+def test_format_source_code_across_a_pool(monkeypatch):
+    source_code = open(
+        os.path.join(os.path.dirname(lib.__file__), 'lib.py')
+    ).read()
+    # small enough that every worker gets a few chunks
+    monkeypatch.setattr(lib, 'PARALLEL_CHUNK_SIZE', 2048)
+
+    pool = multiprocessing.Pool(2)
+    try:
+        result = lib.format_edits(source_code, pool=pool)
+    finally:
+        pool.terminate()
+
+    assert lib.format_edits(source_code) == result
+
+
 @pytest.mark.xfail
 def test_dogfood():
     """We should pass all flake8 rules"""
     assert os.popen('flake8 indently').read() == ''
+
+
+@pytest.mark.skipif(
+    not benchmark.is_compiled(lib),
+    reason="indently.lib isn't compiled",
+)
+@pytest.mark.parametrize('layout', sorted(lib.LAYOUTS))
+def test_compiled_lib_matches_pure_python(layout):
+    pure_lib = benchmark.load_pure_lib()
+    source_code = open(pure_lib.__file__).read()
+
+    assert pure_lib.format_source_code(source_code, layout=layout) == (
+        lib.format_source_code(source_code, layout=layout)
+    )
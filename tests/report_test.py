@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+
+from indently import report
+
+
+def test_run_report():
+    run = report.RunReport()
+    run.add('a.py', 'changed', 0.5, {
+        'bytes_in': 10,
+        'bytes_out': 12,
+        'cache_hits': 1,
+        'cache_misses': 3,
+        'statement_cache_hits': 3,
+        'statement_cache_misses': 1,
+        'statements_skipped': 1,
+    })
+    run.add('b.py', 'unchanged', 1.5, {
+        'bytes_in': 20,
+        'bytes_out': 20,
+        'cache_hits': 0,
+        'cache_misses': 4,
+        'statements_skipped': 0,
+    })
+    run.add('c.py', 'skipped', 0.1, {'bytes_in': 5})
+
+    result = run.to_dict(slowest=2)
+
+    assert {
+        'seen': 3,
+        'changed': 1,
+        'unchanged': 1,
+        'skipped': 1,
+        'failed': 0,
+        'partial': 1,
+    } == result['files']
+    assert 35 == result['bytes_in']
+    assert 32 == result['bytes_out']
+    assert {'hits': 1, 'misses': 7, 'hit_rate': 0.125} == result['cache']
+    assert {'hits': 3, 'misses': 1, 'hit_rate': 0.75} == (
+        result['statement_cache']
+    )
+    assert ['b.py', 'a.py'] == [r['path'] for r in result['slowest']]
+    assert result['peak_rss_kb'] > 0
+
+
+def test_run_report_write(tmpdir):
+    run = report.RunReport()
+    run.add('a.py', 'failed', 0.5, {})
+
+    path = str(tmpdir.join('report.json'))
+    run.write(path)
+
+    with open(path) as f:
+        assert 1 == json.load(f)['files']['failed']
+
+
+def test_merge_run_reports(tmpdir):
+    first = report.RunReport()
+    first.shard = (1, 2)
+    first.add('b.py', 'changed', 0.5, {'bytes_in': 10, 'cache_hits': 2})
+    first.seconds = 2.0
+
+    second = report.RunReport()
+    second.shard = (2, 2)
+    second.add('a.py', 'unchanged', 1.5, {'bytes_in': 20, 'cache_misses': 2})
+    second.seconds = 3.0
+
+    paths = []
+    for i, run in enumerate([first, second]):
+        paths.append(str(tmpdir.join('shard-%d.json' % i)))
+        run.write(paths[-1])
+
+    result = report.RunReport.merge(
+        [report.RunReport.load(path) for path in paths]
+    ).to_dict()
+
+    assert 2 == result['files']['seen']
+    assert 1 == result['files']['changed']
+    assert 30 == result['bytes_in']
+    assert 3.0 == result['seconds']
+    assert 0.5 == result['cache']['hit_rate']
+    assert ['a.py', 'b.py'] == [r['path'] for r in result['per_file']]
+    assert 'shard' not in result
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import multiprocessing
+import os
+import subprocess
+import sys
+
+import pytest
+
+import indently.lib
+from indently import report
+from indently import script
+
+
+def test_parse_shard():
+    assert (2, 4) == script.parse_shard('2/4')
+
+    for value in ['0/4', '5/4', '4', 'a/b']:
+        with pytest.raises(argparse.ArgumentTypeError):
+            script.parse_shard(value)
+
+
+@pytest.mark.parametrize('count', [1, 2, 3, 5])
+def test_shard_sources(tmpdir, count):
+    sizes = [900, 500, 400, 300, 200, 100, 100, 50]
+    paths = []
+    for i, size in enumerate(sizes):
+        path = tmpdir.join('f%d.py' % i)
+        path.write('x' * size)
+        paths.append(str(path))
+
+    def shard(index, order):
+        return [
+            f.name for f in script.shard_sources(
+                [open(path) for path in order], index, count,
+            )
+        ]
+
+    shards = [shard(index, paths) for index in xrange(1, count + 1)]
+
+    # every file goes to exactly one shard, in the order it was given
+    assert sorted(paths) == sorted(sum(shards, []))
+    for names in shards:
+        assert sorted(names, key=paths.index) == names
+
+    # and whichever order the files are listed in, it's the same split
+    for index, names in enumerate(shards, 1):
+        assert set(names) == set(shard(index, paths[::-1]))
+
+    loads = [sum(sizes[paths.index(name)] for name in names)
+             for names in shards]
+    assert max(loads) - min(loads) <= max(sizes)
+
+
+def test_format_staged(tmpdir):
+    long_call = 'x = foo(%s)\n' % ', '.join(
+        'argument%d' % i for i in xrange(12)
+    )
+
+    def git(*args):
+        return subprocess.check_output(('git',) + args, cwd=str(tmpdir))
+
+    git('init', '-q')
+    tmpdir.join('formatted.py').write('y = 1\n')
+    tmpdir.join('staged.py').write(long_call)
+    tmpdir.join('unstaged.py').write(long_call)
+    tmpdir.join('README').write(long_call)
+    git('add', '.')
+    tmpdir.join('unstaged.py').write(long_call + '# not staged\n')
+
+    with tmpdir.as_cwd():
+        run = report.RunReport()
+        assert 2 == script.format_staged(
+            script.parse_args(['--staged']),
+            run,
+        )
+
+    assert ['changed', 'changed', 'unchanged'] == sorted(
+        record['status'] for record in run.files
+    )
+
+    formatted = git('show', ':staged.py')
+    assert formatted != long_call
+    assert formatted == git('show', ':unstaged.py')
+    assert long_call == git('show', ':README')
+
+    # the working tree only catches up if it had nothing else going on
+    assert formatted == tmpdir.join('staged.py').read()
+    assert long_call + '# not staged\n' == tmpdir.join('unstaged.py').read()
+
+
+LONG_CALL = 'x = foo(%s)\n' % ', '.join('argument%d' % i for i in xrange(12))
+
+
+@pytest.mark.parametrize('jobs', [None, 2])
+def test_format_staged_uses_the_cache(tmpdir, jobs):
+    def git(*args):
+        return subprocess.check_output(('git',) + args, cwd=str(tmpdir))
+
+    git('init', '-q')
+    tmpdir.join('staged.py').write(LONG_CALL)
+    git('add', '.')
+
+    cache_path = str(tmpdir.join('cache'))
+    args = script.parse_args(['--staged', '--diff', '--cache', cache_path])
+    pool = multiprocessing.Pool(jobs) if jobs else None
+
+    def run_staged():
+        run = report.RunReport()
+        statements = indently.lib.StatementCache(cache_path)
+        with tmpdir.as_cwd():
+            script.format_staged(args, run, pool, statements)
+        statements.save()
+        return run.to_dict()['statement_cache']
+
+    try:
+        first = run_staged()
+        second = run_staged()
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    assert (0, 1) == (first['hits'], first['misses'])
+    assert (1, 0) == (second['hits'], second['misses'])
+
+
+@pytest.fixture
+def stdin(monkeypatch):
+    # rewrite_file checks whether it's been handed stdin, which pytest's
+    # stand-in can't answer
+    monkeypatch.setattr(sys, 'stdin', open(os.devnull))
+
+
+def test_rewrite_file_leaves_formatted_files_alone(tmpdir, stdin):
+    path = tmpdir.join('formatted.py')
+    path.write('y = 1\n')
+    path.setmtime(1000000000)
+    inode = path.stat().ino
+
+    args = script.parse_args(['-i', str(path)])
+    assert not script.rewrite_file(args.source[0], args)
+
+    assert 1000000000 == path.mtime()
+    assert inode == path.stat().ino
+
+
+def test_rewrite_file_writes_atomically(tmpdir, stdin):
+    path = tmpdir.join('long.py')
+    path.write(LONG_CALL)
+    path.chmod(0o640)
+    inode = path.stat().ino
+
+    args = script.parse_args(['-i', str(path)])
+    assert script.rewrite_file(args.source[0], args)
+
+    # a whole new file, renamed over the old one
+    assert inode != path.stat().ino
+    assert 0o640 == path.stat().mode & 0o777
+    assert LONG_CALL != path.read()
+    assert ['long.py'] == [p.basename for p in tmpdir.listdir()]
+
+
+def test_write_atomically_cleans_up_after_itself(tmpdir, monkeypatch):
+    path = tmpdir.join('long.py')
+    path.write(LONG_CALL)
+
+    def rename(src, dst):
+        raise OSError('no room')
+
+    monkeypatch.setattr(os, 'rename', rename)
+    with pytest.raises(OSError):
+        script.write_atomically(str(path), 'x = 1\n')
+
+    assert LONG_CALL == path.read()
+    assert ['long.py'] == [p.basename for p in tmpdir.listdir()]
+
+
+def test_write_atomically_keeps_links(tmpdir):
+    target = tmpdir.join('target.py')
+    target.write(LONG_CALL)
+    link = tmpdir.join('link.py')
+    link.mksymlinkto(target)
+    hard = tmpdir.join('hard.py')
+    os.link(str(target), str(hard))
+
+    script.write_atomically(str(link), 'x = 1\n')
+
+    assert link.islink()
+    assert 'x = 1\n' == target.read()
+    assert 'x = 1\n' == hard.read()
+
+    # once it's the only link, it gets swapped out whole again
+    hard.remove()
+    script.write_atomically(str(target), 'x = 2\n')
+
+    assert link.islink()
+    assert 'x = 2\n' == link.read()
+
+
+def test_reformat_changed(tmpdir, stdin, monkeypatch):
+    for name in ['a.py', 'b.py', 'c.py']:
+        tmpdir.join(name).write(LONG_CALL)
+    paths = [str(tmpdir)]
+    args = script.parse_args(['--watch', str(tmpdir)])
+    args.in_place = True
+
+    mtimes = script.snapshot(paths)
+    tmpdir.join('a.py').write(LONG_CALL + 'y = 1\n')
+    tmpdir.join('c.py').write('z = (\n    1)\n')
+    current = script.snapshot(paths)
+
+    rewrite_file = script.rewrite_file
+
+    def rewrite_while_editing(f, *args, **kwargs):
+        # somebody saves b.py while we're busy with a.py
+        if f.name.endswith('a.py'):
+            tmpdir.join('b.py').write(LONG_CALL + '# edited\n')
+            tmpdir.join('b.py').setmtime(2000000000)
+        return rewrite_file(f, *args, **kwargs)
+
+    monkeypatch.setattr(script, 'rewrite_file', rewrite_while_editing)
+
+    mtimes = script.reformat_changed(current, mtimes, args)
+
+    assert LONG_CALL != tmpdir.join('a.py').read()
+    assert 'z = (1)\n' == tmpdir.join('c.py').read()
+
+    # our own writes aren't changes, but the save to b.py still is
+    after = script.snapshot(paths)
+    assert ['b.py'] == [
+        os.path.basename(path) for path in sorted(after)
+        if after[path] != mtimes[path]
+    ]
+
+
+def test_reformat_changed_keeps_saves_made_while_formatting(
+    tmpdir, stdin, monkeypatch
+):
+    path = tmpdir.join('a.py')
+    path.write(LONG_CALL)
+    paths = [str(tmpdir)]
+    args = script.parse_args(['--watch', str(tmpdir)])
+    args.in_place = True
+
+    format_edits = indently.lib.format_edits
+
+    def format_while_editing(*args, **kwargs):
+        # somebody saves a.py again before we're done with it
+        path.write(LONG_CALL + '# edited\n')
+        path.setmtime(2000000000)
+        return format_edits(*args, **kwargs)
+
+    monkeypatch.setattr(indently.lib, 'format_edits', format_while_editing)
+
+    current = script.snapshot(paths)
+    mtimes = script.reformat_changed(current, {}, args)
+
+    assert LONG_CALL + '# edited\n' == path.read()
+
+    # and it still gets formatted, next time around
+    monkeypatch.setattr(indently.lib, 'format_edits', format_edits)
+    current = script.snapshot(paths)
+    assert current != mtimes
+    script.reformat_changed(current, mtimes, args)
+
+    assert LONG_CALL not in path.read()
+    assert '# edited' in path.read()
+
+
+def test_reformat_changed_carries_on_after_errors(
+    tmpdir, stdin, monkeypatch, capsys,
+):
+    for name in ['a.py', 'b.py']:
+        tmpdir.join(name).write(LONG_CALL)
+    args = script.parse_args(['--watch', str(tmpdir)])
+    args.in_place = True
+
+    rewrite_file = script.rewrite_file
+
+    def rewrite_or_fail(f, *args, **kwargs):
+        if f.name.endswith('a.py'):
+            raise ValueError('something we never saw coming')
+        return rewrite_file(f, *args, **kwargs)
+
+    monkeypatch.setattr(script, 'rewrite_file', rewrite_or_fail)
+
+    current = script.snapshot([str(tmpdir)])
+    mtimes = script.reformat_changed(current, {}, args)
+
+    assert script.snapshot([str(tmpdir)]) == mtimes
+
+    assert LONG_CALL == tmpdir.join('a.py').read()
+    assert LONG_CALL != tmpdir.join('b.py').read()
+    assert 'something we never saw coming' in capsys.readouterr()[1]